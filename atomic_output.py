@@ -0,0 +1,145 @@
+import contextvars
+import logging
+import os
+import stat
+import time as ttime
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+from prefect import get_run_logger
+from prefect.exceptions import MissingContextError
+from prefect.logging import get_logger
+
+# Size of the write buffer of atomic_write, so that an exported file reaches
+# the (NFS) proposal directory in a few large writes.
+WRITE_BUFFER_BYTES = 4 * 2**20
+
+# Exported files are made group-writable so that the other members of the
+# proposal (and the beamline staff) can modify or remove them, see
+# https://nsls2.slack.com/archives/C04UUSG88VB/p1718911163624149
+GROUP_WRITE = stat.S_IWGRP
+
+# Records of the innermost write_stats() block of the current context.
+_write_stats = contextvars.ContextVar("write_stats", default=None)
+
+logger = get_logger(__name__)
+
+
+def _logger():
+    try:
+        return get_run_logger()
+    except MissingContextError:
+        return logger
+
+
+def set_group_writable(path):
+    """Add group write permission to path."""
+    os.chmod(path, os.stat(path).st_mode | GROUP_WRITE)
+
+
+@contextmanager
+def write_stats():
+    """
+    Collect the files written by atomic_write, atomic_path and append_write
+    in this block.
+
+    Yields a list that receives one {"path", "bytes", "seconds"} dict per
+    file, seconds being the time from opening the temporary file to the
+    rename.
+    """
+    records = []
+    token = _write_stats.set(records)
+    try:
+        yield records
+    finally:
+        _write_stats.reset(token)
+
+
+def _temp_path(path):
+    # Hidden and in the target directory, so that the rename stays on one file
+    # system and globs of the exported files do not see it. The suffix is kept
+    # for writers that infer the format from it (PIL).
+    return path.with_name(f".{path.stem}.{uuid.uuid4().hex[:8]}.tmp{path.suffix}")
+
+
+def _record_write(path, nbytes, elapsed_time):
+    record = {"path": str(path), "bytes": nbytes, "seconds": elapsed_time}
+    records = _write_stats.get()
+    if records is not None:
+        records.append(record)
+    # Hidden files and folders hold bookkeeping (indexes, states, manifests).
+    hidden = path.name.startswith(".") or path.parent.name.startswith(".")
+    level = logging.DEBUG if hidden else logging.INFO
+    _logger().log(level, f"Wrote {path}: {nbytes:_} bytes in {elapsed_time:.3f} s")
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yield a temporary path to write path through, e.g. with h5py or PIL.
+
+    The temporary file is created by the caller in the target directory; when
+    the block exits without error it is made group-writable and renamed over
+    path, so readers see either the old or the complete new file. On error it
+    is removed and path is left untouched.
+    """
+    path = Path(path)
+    tmp_path = _temp_path(path)
+    start_time = ttime.monotonic()
+    try:
+        yield str(tmp_path)
+        set_group_writable(tmp_path)
+        nbytes = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    _record_write(path, nbytes, ttime.monotonic() - start_time)
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """
+    Open a buffered temporary file that replaces path atomically on exit.
+
+    mode: "w" or "wb"
+
+    See atomic_path. The data is buffered in WRITE_BUFFER_BYTES blocks, so
+    many small writes cost few round trips to the file system.
+    """
+    if mode not in ("w", "wb"):
+        raise ValueError(f"Unsupported mode {mode!r}")
+    with (
+        atomic_path(path) as tmp_path,
+        open(tmp_path, mode, buffering=WRITE_BUFFER_BYTES) as f,
+    ):
+        yield f
+
+
+@contextmanager
+def append_write(path, mode="a"):
+    """
+    Open path to add to its end in place, e.g. a line to a logfile.
+
+    mode: "a" or "ab"
+
+    Unlike atomic_write, the cost does not grow with the size of the file.
+    The data is flushed and fsynced on exit, and a new file is made
+    group-writable. Readers can see a partly written end, and the caller
+    must hold a lock on the file (see logscan.file_lock) so that appends do
+    not interleave.
+    """
+    if mode not in ("a", "ab"):
+        raise ValueError(f"Unsupported mode {mode!r}")
+    path = Path(path)
+    start_time = ttime.monotonic()
+    with open(path, mode, buffering=WRITE_BUFFER_BYTES) as f:
+        offset = f.tell()
+        if offset == 0:
+            set_group_writable(path)
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+        nbytes = f.tell() - offset
+    _record_write(path, nbytes, ttime.monotonic() - start_time)
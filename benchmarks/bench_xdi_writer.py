@@ -0,0 +1,120 @@
+"""
+Compare the per-cell XDI writer that xanes_textout used to have with the
+bulk writer (xanes_exporter.format_xdi_rows).
+
+Both paths write the data block of a synthetic XAS step scan to a temporary
+directory; the script checks that the files are byte-identical and prints the
+time taken by each path.
+
+    pixi run python benchmarks/bench_xdi_writer.py --points 5000 --rois 4
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time as ttime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from xanes_exporter import format_xdi_rows  # noqa: E402
+
+
+def make_scan(n_points, n_rois, n_channels, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = {
+        "energy_energy": np.linspace(7000, 7500, n_points),
+        "energy_bragg": rng.uniform(10, 20, n_points),
+        "energy_c2_x": rng.uniform(-1, 1, n_points),
+        "sclr_im": rng.integers(0, 10**6, n_points),
+        "sclr_i0": rng.integers(0, 10**6, n_points),
+        "sclr_it": rng.integers(0, 10**6, n_points),
+    }
+    usercolumns = {}
+    for roi in range(1, n_rois + 1):
+        roi_keys = [
+            f"xs_channel{ch:02}_mcaroi{roi:02}_total_rbv"
+            for ch in range(1, n_channels + 1)
+        ]
+        for key in roi_keys:
+            columns[key] = rng.uniform(0, 1e5, n_points).astype(np.float32)
+        roisum = pd.Series(sum(columns[key] for key in roi_keys))
+        roisum = roisum.rename_axis("seq_num").rename(lambda x: x + 1)
+        usercolumns[f"If-{roi:02}"] = roisum
+    return columns, usercolumns
+
+
+def write_legacy(path, file_data, usercolumn):
+    column = list(file_data)
+    usercolumnname = list(usercolumn)
+    with open(path, "w") as f:
+        offset = False
+        for idx in range(len(file_data[column[0]])):
+            for item in column:
+                if item in file_data:
+                    f.write("{0:8.6g}  ".format(file_data[item][idx]))
+            for item in usercolumnname:
+                if item in usercolumn:
+                    if offset is False:
+                        try:
+                            f.write("{0:8.6g}  ".format(usercolumn[item][idx]))
+                        except KeyError:
+                            offset = True
+                            f.write("{0:8.6g}  ".format(usercolumn[item][idx + 1]))
+                    else:
+                        f.write("{0:8.6g}  ".format(usercolumn[item][idx + 1]))
+            f.write("\n")
+
+
+def write_bulk(path, file_data, usercolumn):
+    with open(path, "w") as f:
+        f.write(format_xdi_rows(list(file_data.values()), list(usercolumn.values())))
+
+
+def timed(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = ttime.perf_counter()
+        func(*args)
+        best = min(best, ttime.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--points", type=int, default=2000)
+    parser.add_argument("--rois", type=int, default=4)
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    file_data, usercolumn = make_scan(args.points, args.rois, args.channels)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        legacy_path = os.path.join(tmpdir, "legacy.txt")
+        bulk_path = os.path.join(tmpdir, "bulk.txt")
+        legacy = timed(
+            write_legacy, legacy_path, file_data, usercolumn, repeat=args.repeat
+        )
+        bulk = timed(write_bulk, bulk_path, file_data, usercolumn, repeat=args.repeat)
+        with open(legacy_path, "rb") as f:
+            legacy_bytes = f.read()
+        with open(bulk_path, "rb") as f:
+            bulk_bytes = f.read()
+
+    n_cells = args.points * (len(file_data) + len(usercolumn))
+    print(f"{args.points} points x {len(file_data) + len(usercolumn)} columns")
+    print(f"legacy: {legacy:.4f} s ({n_cells / legacy:,.0f} cells/s)")
+    print(f"bulk:   {bulk:.4f} s ({n_cells / bulk:,.0f} cells/s)")
+    print(f"speedup: {legacy / bulk:.1f}x")
+    if legacy_bytes != bulk_bytes:
+        print("ERROR: outputs differ")
+        return 1
+    print(f"outputs identical ({len(bulk_bytes):_} bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""
+Check that a live XAS step export matches the export of the whole run.
+
+A synthetic XAS step scan is exported twice to a temporary proposals
+directory: once through the live exporter (update_live_export, then the
+finalization done by xas_step_exporter) and once by xas_step_exporter
+alone. The script checks that both files are byte-identical and exits with
+1 if they are not. By default a column of the file layout (energy_c2_x) is
+missing from the run, so the column numbering of the header is covered.
+
+    pixi run python benchmarks/check_live_export.py
+    pixi run python benchmarks/check_live_export.py --missing none --points 5000
+"""
+
+import argparse
+import difflib
+import os
+import sys
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+API_KEY = "benchmark"
+
+
+def export(uid, live):
+    """Export the run, through the live exporter if live, and return the file."""
+    from data_validation import get_run
+    from xanes_exporter import export_xas_step, update_live_export, xanes_filepath
+
+    h = get_run.fn(uid, api_key=API_KEY)
+    filepath = xanes_filepath(h.start)
+    if live:
+        update_live_export(h)
+    export_xas_step(uid, api_key=API_KEY)
+    with open(filepath) as f:
+        content = f.read()
+    os.remove(filepath)
+    return content
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare a live XAS step export with a full export."
+    )
+    parser.add_argument("--points", type=int, default=500)
+    parser.add_argument(
+        "--missing",
+        nargs="+",
+        default=["energy_c2_x"],
+        help='keys left out of the run ("none" for none)',
+    )
+    args = parser.parse_args(argv)
+    missing = [key for key in args.missing if key != "none"]
+
+    os.environ["SRX_PROPOSALS_DIR"] = tempfile.mkdtemp(prefix="srx-live-check-")
+    sys.path.insert(0, BENCHMARK_DIR)
+    sys.path.insert(0, REPO_DIR)
+
+    import synthetic
+    from prefect import flow
+    from prefect.testing.utilities import prefect_test_harness
+
+    from data_validation import set_tiled_client
+
+    start, run = synthetic.xas_step_run(
+        1101, n_points=args.points, missing_keys=missing
+    )
+    set_tiled_client(synthetic.serve({start["uid"]: run}), api_key=API_KEY)
+
+    @flow(name="check-live-export")
+    def check():
+        return export(start["uid"], live=True), export(start["uid"], live=False)
+
+    with prefect_test_harness():
+        live, full = check()
+
+    if live == full:
+        print(f"Live export matches the full export (missing keys: {missing})")
+        return 0
+    print(f"Live export differs from the full export (missing keys: {missing}):")
+    sys.stdout.writelines(
+        difflib.unified_diff(
+            full.splitlines(keepends=True),
+            live.splitlines(keepends=True),
+            "full",
+            "live",
+            n=1,
+        )
+    )
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
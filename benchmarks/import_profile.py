@@ -0,0 +1,165 @@
+"""
+Import-time profile of the flow modules.
+
+Each module is imported in a fresh interpreter with `python -X importtime`,
+which is what a flow run pays before its first task can start. For every
+module the wall time of the import and the import time of each top-level
+package it pulls in are recorded; heavy optional packages that got imported
+are listed so that eager imports stand out.
+
+    # profile all flow modules, print the heaviest packages of each
+    pixi run python benchmarks/import_profile.py
+
+    # store a profile, then compare two of them
+    pixi run python benchmarks/import_profile.py --output before.json
+    pixi run python benchmarks/import_profile.py --compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Modules imported by the Prefect deployments (see prefect.yaml), the flow
+# entrypoint first.
+MODULES = [
+    "end_of_run_workflow",
+    "data_validation",
+    "logscan",
+    "notifications",
+    "export_manifest",
+    "xanes_exporter",
+    "xrf_hdf5_exporter",
+    "vlm_snapshot_exporter",
+]
+
+# Packages that only some exporters need; they should not be imported just by
+# importing a flow module.
+HEAVY_PACKAGES = ["pyxrf", "dask", "xraylib", "pandas", "PIL", "h5py"]
+
+
+def parse_importtime(stderr):
+    """
+    Parse `-X importtime` output.
+
+    Returns a dict mapping each imported module to its self and cumulative
+    import time, in seconds.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # the column header
+            continue
+        modules[fields[2].strip()] = (self_us / 1e6, cumulative_us / 1e6)
+    return modules
+
+
+def profile_import(module):
+    """Import module in a fresh interpreter and return its import profile."""
+    code = (
+        "import time; t = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - t)"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if proc.returncode:
+        return {"error": proc.stderr.strip().splitlines()[-1]}
+    modules = parse_importtime(proc.stderr)
+    packages = {}
+    for name, (self_time, _) in modules.items():
+        root = name.split(".")[0]
+        packages[root] = packages.get(root, 0.0) + self_time
+    return {
+        "wall_time": float(proc.stdout.split()[-1]),
+        "packages": packages,
+        "heavy": [name for name in HEAVY_PACKAGES if name in packages],
+    }
+
+
+def profile(modules, repeat):
+    """Profile each module repeat times and keep the run of median wall time."""
+    results = {}
+    for module in modules:
+        runs = [profile_import(module) for _ in range(repeat)]
+        if any("error" in run for run in runs):
+            results[module] = next(run for run in runs if "error" in run)
+            continue
+        median = statistics.median_low(run["wall_time"] for run in runs)
+        results[module] = next(run for run in runs if run["wall_time"] == median)
+    return results
+
+
+def report(results, top):
+    for module, result in results.items():
+        if "error" in result:
+            print(f"{module:24} FAILED: {result['error']}")
+            continue
+        heavy = ", ".join(result["heavy"]) or "-"
+        print(f"{module:24} {result['wall_time']:7.3f} s   heavy: {heavy}")
+        packages = sorted(result["packages"].items(), key=lambda p: -p[1])
+        for name, seconds in packages[:top]:
+            print(f"    {name:24} {seconds:7.3f} s")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    for module, new_result in new.items():
+        old_result = old.get(module)
+        if not old_result or "error" in old_result or "error" in new_result:
+            print(f"{module:24} (not comparable)")
+            continue
+        before, after = old_result["wall_time"], new_result["wall_time"]
+        dropped = sorted(set(old_result["heavy"]) - set(new_result["heavy"]))
+        print(
+            f"{module:24} {before:7.3f} s -> {after:7.3f} s "
+            f"({(after - before) / before:+.1%})"
+            + (f"   no longer imports: {', '.join(dropped)}" if dropped else "")
+        )
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import-time profile of the SRX flow modules."
+    )
+    parser.add_argument(
+        "modules", nargs="*", help=f"modules to profile: {', '.join(MODULES)}"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="packages shown")
+    parser.add_argument("--output", help="where to store the profile (JSON)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare)
+
+    results = profile(args.modules or MODULES, args.repeat)
+    report(results, args.top)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Profile written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""
+Offline benchmarks of the exporters against synthetic runs.
+
+Each case runs in a fresh Python process with an in-process Tiled app
+(benchmarks/synthetic.py), a temporary Prefect server (prefect_test_harness)
+and a temporary proposals directory, so no network or beamline filesystem is
+needed. For every case the wall time, peak RSS and bytes written are recorded.
+
+    # run all cases and store the results in benchmarks/results/
+    pixi run python benchmarks/run_benchmarks.py
+
+    # run some cases on a larger data set
+    pixi run python benchmarks/run_benchmarks.py --scale 4 xas_fly_exporter
+
+    # compare two stored results
+    pixi run python benchmarks/run_benchmarks.py --compare OLD.json NEW.json
+
+Note that the synthetic data lives in the same process as the exporter, so
+the absolute peak RSS includes it; compare peak RSS between commits rather
+than reading it in isolation.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time as ttime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+API_KEY = "benchmark"
+
+# Relative change in wall time or peak RSS reported as a regression.
+REGRESSION_THRESHOLD = 0.10
+
+
+def _scaled(value, scale):
+    return max(int(value * scale), 1)
+
+
+def _case_xas_step(scale):
+    import synthetic
+
+    from xanes_exporter import xas_step_exporter
+
+    start, run = synthetic.xas_step_run(1001, n_points=_scaled(1000, scale))
+    return {start["uid"]: run}, lambda: xas_step_exporter.fn(
+        start["uid"], api_key=API_KEY
+    )
+
+
+def _case_xas_fly(scale):
+    import synthetic
+
+    from xanes_exporter import xas_fly_exporter
+
+    start, run = synthetic.xas_fly_run(1002, n_points=_scaled(500, scale))
+    return {start["uid"]: run}, lambda: xas_fly_exporter.fn(
+        start["uid"], api_key=API_KEY
+    )
+
+
+def _case_vlm(scale):
+    import synthetic
+
+    from vlm_snapshot_exporter import export_vlm_image
+
+    start, run = synthetic.camera_snapshot_run(1003)
+    return {start["uid"]: run}, lambda: export_vlm_image.fn(
+        start["scan_id"], api_key=API_KEY
+    )
+
+
+def _case_logscan(scale):
+    import synthetic
+
+    from logscan import logscan_detailed
+
+    start, run = synthetic.xrf_fly_run(1004)
+    return {start["uid"]: run}, lambda: logscan_detailed.fn(
+        start["uid"], api_key=API_KEY
+    )
+
+
+def _case_validate_xrf(scale):
+    import synthetic
+
+    from data_validation import get_run, validate_stream
+
+    n = _scaled(40, scale**0.5)
+    start, run = synthetic.xrf_fly_run(1005, nx=n, ny=n)
+    return {start["uid"]: run}, lambda: validate_stream(
+        get_run.fn(start["uid"], api_key=API_KEY)["stream0"]
+    )
+
+
+CASES = {
+    # xanes_textout is driven by the step-scan exporter
+    "xas_step_exporter": _case_xas_step,
+    "xas_fly_exporter": _case_xas_fly,
+    "export_vlm_image": _case_vlm,
+    "logscan_detailed": _case_logscan,
+    "validate_stream": _case_validate_xrf,
+}
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _bytes_written(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+def run_case(name, scale):
+    """Run one case in this process and return its measurements."""
+    proposals_dir = os.environ["SRX_PROPOSALS_DIR"]
+    sys.path.insert(0, REPO_DIR)
+
+    import synthetic
+    from prefect import flow
+    from prefect.testing.utilities import prefect_test_harness
+
+    from data_validation import set_tiled_client
+
+    # The proposal directory exists on the beamline filesystem; logscan
+    # expects it to be there.
+    os.makedirs(
+        os.path.join(proposals_dir, synthetic.CYCLE, synthetic.DATA_SESSION),
+        exist_ok=True,
+    )
+    runs, target = CASES[name](scale)
+    set_tiled_client(synthetic.serve(runs), api_key=API_KEY)
+
+    @flow(name=f"benchmark-{name}")
+    def benchmark():
+        rss_before = _peak_rss_bytes()
+        start_time = ttime.perf_counter()
+        target()
+        elapsed_time = ttime.perf_counter() - start_time
+        return {
+            "wall_time": elapsed_time,
+            "peak_rss": _peak_rss_bytes(),
+            "peak_rss_increase": _peak_rss_bytes() - rss_before,
+        }
+
+    with prefect_test_harness():
+        result = benchmark()
+    result["bytes_written"] = _bytes_written(proposals_dir)
+    return result
+
+
+def _git(*args):
+    try:
+        return subprocess.check_output(
+            ["git", *args], cwd=REPO_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(names, scale):
+    results = {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": scale,
+        "cases": {},
+    }
+    for name in names:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = dict(os.environ)
+            env["SRX_PROPOSALS_DIR"] = tmpdir
+            env["PREFECT_LOGGING_LEVEL"] = "WARNING"
+            proc = subprocess.run(
+                [sys.executable, __file__, "--child", name, "--scale", str(scale)],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=False,
+            )
+        lines = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+        if proc.returncode or not lines:
+            print(f"{name}: FAILED\n{proc.stderr[-2000:]}")
+            results["cases"][name] = {"error": proc.stderr[-2000:]}
+            continue
+        result = json.loads(lines[-1])
+        results["cases"][name] = result
+        print(
+            f"{name:20} {result['wall_time']:8.3f} s "
+            f"{result['peak_rss'] / 2**20:8.1f} MiB peak RSS "
+            f"{result['bytes_written']:>14_} bytes written"
+        )
+    return results
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"old: {old['commit']} ({old['date']})")
+    print(f"new: {new['commit']} ({new['date']})")
+    regressions = 0
+    for name, new_result in new["cases"].items():
+        old_result = old["cases"].get(name)
+        if not old_result or "error" in old_result or "error" in new_result:
+            print(f"{name:20} (not comparable)")
+            continue
+        cells = []
+        for metric in ("wall_time", "peak_rss", "bytes_written"):
+            before, after = old_result[metric], new_result[metric]
+            change = (after - before) / before if before else 0.0
+            flag = ""
+            if metric != "bytes_written" and change > REGRESSION_THRESHOLD:
+                flag = " !"
+                regressions += 1
+            cells.append(f"{metric} {change:+7.1%}{flag}")
+        print(f"{name:20} " + "  ".join(cells))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks of the SRX exporters."
+    )
+    parser.add_argument("cases", nargs="*", help=f"cases to run: {', '.join(CASES)}")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--output", help="where to store the results (JSON)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(sorted(unknown))}")
+
+    if args.compare:
+        return compare(*args.compare)
+    if args.child:
+        print(json.dumps(run_case(args.child, args.scale)))
+        return 0
+
+    results = run_all(args.cases or list(CASES), args.scale)
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+        output = os.path.join(
+            RESULTS_DIR, f"{stamp}-{(results['commit'] or 'unknown')[:8]}.json"
+        )
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
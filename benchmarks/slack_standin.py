@@ -0,0 +1,67 @@
+"""
+Local HTTP stand-in for the Slack webhooks.
+
+Point the notifier at it to see the messages a flow would send without
+posting to Slack:
+
+    pixi run python benchmarks/slack_standin.py --port 8765 &
+    SRX_SLACK_URL=http://localhost:8765 pixi run python ...
+
+Every POSTed JSON message is printed as one line on stdout. An optional delay
+emulates a slow webhook.
+"""
+
+import argparse
+import contextlib
+import json
+import sys
+import threading
+import time as ttime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SlackStandin(ThreadingHTTPServer):
+    """HTTP server that records the JSON messages POSTed to it."""
+
+    def __init__(self, address=("localhost", 0), delay=0.0):
+        super().__init__(address, _Handler)
+        self.delay = delay
+        self.messages = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        ttime.sleep(self.server.delay)
+        message = json.loads(body)
+        with self.server.lock:
+            self.server.messages.append(message)
+        print(json.dumps(message), flush=True)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for Slack webhooks.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds per POST")
+    args = parser.parse_args(argv)
+    server = SlackStandin(("localhost", args.port), delay=args.delay)
+    print(f"Listening on {server.url}", file=sys.stderr)
+    with contextlib.suppress(KeyboardInterrupt):
+        server.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
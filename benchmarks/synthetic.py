@@ -0,0 +1,201 @@
+"""
+Synthetic bluesky runs served by an in-process Tiled app.
+
+The runs mimic the layout the exporters read from tiled.nsls2.bnl.gov
+(srx/raw/<uid>/<stream>/data/<key>, start/stop documents in the run metadata
+and event descriptors in the stream metadata), so the flows can be exercised
+on a laptop without network access.
+"""
+
+import uuid
+
+import numpy as np
+import xarray as xr
+from tiled.adapters.mapping import MapAdapter
+from tiled.adapters.xarray import DatasetAdapter
+from tiled.client import Context, from_context
+from tiled.server.app import build_app
+from tiled.structures.core import Spec
+
+CYCLE = "2026-1"
+PROPOSAL_ID = "300000"
+DATA_SESSION = f"pass-{PROPOSAL_ID}"
+
+
+def stream_adapter(data, descriptors=()):
+    """Return a BlueskyEventStream adapter with one variable per key of data."""
+    variables = {}
+    for key, value in data.items():
+        dims = ("time",) + tuple(f"dim_{key}_{i}" for i in range(value.ndim - 1))
+        variables[key] = (dims, value)
+    return MapAdapter(
+        {"data": DatasetAdapter.from_dataset(xr.Dataset(variables))},
+        metadata={"descriptors": list(descriptors)},
+        specs=[Spec("BlueskyEventStream", version="1.0")],
+    )
+
+
+def run_adapter(start, streams):
+    stop = {
+        "uid": str(uuid.uuid4()),
+        "run_start": start["uid"],
+        "time": start["time"] + 60,
+        "exit_status": "success",
+        "reason": "",
+    }
+    return MapAdapter(
+        streams,
+        metadata={"start": start, "stop": stop},
+        specs=[Spec("BlueskyRun", version="1.0")],
+    )
+
+
+def start_document(scan_id, scan=None, **kwargs):
+    start = {
+        "uid": str(uuid.UUID(int=scan_id)),
+        "scan_id": scan_id,
+        "time": 1.77e9 + scan_id,
+        "beamline_id": "SRX",
+        "cycle": CYCLE,
+        "data_session": DATA_SESSION,
+        "proposal": {"proposal_id": PROPOSAL_ID, "type": "General User"},
+        "plan_name": "scan",
+    }
+    if scan is not None:
+        start["scan"] = scan
+    start.update(kwargs)
+    return start
+
+
+def baseline_stream():
+    return stream_adapter({"ring_current": np.array([400.1, 400.0])})
+
+
+def xas_step_run(
+    scan_id, n_points=1000, n_channels=8, rois=(1, 2, 3, 4), missing_keys=(), seed=0
+):
+    """
+    XAS_STEP scan with the SRS scaler and n_channels Xspress3 ROIs.
+
+    missing_keys: keys of the file layout left out of the primary stream
+    """
+    rng = np.random.default_rng(seed)
+    data = {
+        "energy_energy": np.linspace(7000, 7500, n_points),
+        "energy_bragg": rng.uniform(10, 20, n_points),
+        "energy_c2_x": rng.uniform(-1, 1, n_points),
+        "ring_current": rng.uniform(399, 401, n_points),
+        "sclr_im": rng.integers(0, 10**6, n_points).astype(np.float64),
+        "sclr_i0": rng.integers(0, 10**6, n_points).astype(np.float64),
+        "sclr_it": rng.integers(0, 10**6, n_points).astype(np.float64),
+    }
+    xs_keys = []
+    for roi in rois:
+        for ch in range(1, n_channels + 1):
+            key = f"xs_channel{ch:02}_mcaroi{roi:02}_total_rbv"
+            data[key] = rng.uniform(0, 1e5, n_points)
+            xs_keys.append(key)
+    for key in missing_keys:
+        del data[key]
+    descriptors = [
+        {
+            "name": "primary",
+            "object_keys": {
+                "sclr1": ["sclr_im", "sclr_i0", "sclr_it"],
+                "xs": xs_keys,
+            },
+        }
+    ]
+    start = start_document(
+        scan_id,
+        {"type": "XAS_STEP", "sample_name": "synthetic", "ROI": list(rois)},
+        detectors=["sclr1", "xs"],
+    )
+    streams = {
+        "primary": stream_adapter(data, descriptors),
+        "baseline": baseline_stream(),
+    }
+    return start, run_adapter(start, streams)
+
+
+def xas_fly_run(scan_id, n_points=500, n_streams=4, n_channels=4, n_bins=4096, seed=0):
+    """XAS_FLY scan with n_streams passes of n_channels MCA channels."""
+    rng = np.random.default_rng(seed)
+    streams = {"baseline": baseline_stream()}
+    for i in range(n_streams):
+        data = {
+            "energy": np.linspace(7000, 7500, n_points),
+            "i0": rng.uniform(0, 1e5, n_points),
+            "it": rng.uniform(0, 1e5, n_points),
+            "time": np.arange(n_points, dtype=np.float64),
+        }
+        for ch in range(1, n_channels + 1):
+            data[f"xs_channel{ch:02}"] = rng.integers(
+                0, 100, (n_points, 1, n_bins), dtype=np.uint32
+            )
+        streams[f"scan_{i:03}"] = stream_adapter(data)
+    start = start_document(
+        scan_id,
+        {
+            "type": "XAS_FLY",
+            "harmonic": 3,
+            "roi_num": 1,
+            "roi_names": ["Fe_ka1", "Mn_ka1", "Cu_ka1", "Zn_kb1"],
+        },
+    )
+    return start, run_adapter(start, streams)
+
+
+def xrf_fly_run(scan_id, nx=40, ny=40, n_channels=4, n_bins=4096, seed=0):
+    """XRF_FLY map of nx x ny pixels with n_channels MCA channels."""
+    rng = np.random.default_rng(seed)
+    data = {
+        "i0": rng.uniform(0, 1e5, (ny, nx)),
+        "x_pos": np.tile(np.linspace(0, 10, nx), (ny, 1)),
+        "y_pos": np.repeat(np.linspace(0, 10, ny)[:, None], nx, axis=1),
+    }
+    for ch in range(1, n_channels + 1):
+        data[f"xs_channel{ch:02}_fluor"] = rng.integers(
+            0, 50, (ny, nx, n_bins), dtype=np.uint32
+        )
+    start = start_document(
+        scan_id,
+        {"type": "XRF_FLY", "scan_input": [0, 10, nx, 0, 10, ny, 0.1]},
+        detectors=["xs", "sclr1"],
+    )
+    streams = {"stream0": stream_adapter(data), "baseline": baseline_stream()}
+    return start, run_adapter(start, streams)
+
+
+def camera_snapshot_run(scan_id, n_frames=2, height=1024, width=1280, seed=0):
+    """count scan with before/after VLM snapshots in camera_snapshot."""
+    rng = np.random.default_rng(seed)
+    images = rng.integers(0, 2**12, (n_frames, 1, height, width), dtype=np.uint16)
+    start = start_document(scan_id, plan_name="count", detectors=["nano_vlm"])
+    streams = {
+        "primary": stream_adapter({"det": np.zeros(1)}),
+        "camera_snapshot": stream_adapter({"nano_vlm_image": images}),
+        "baseline": baseline_stream(),
+    }
+    return start, run_adapter(start, streams)
+
+
+def serve(runs):
+    """
+    Serve runs ({uid: run adapter}) from an in-process Tiled app.
+
+    Returns a client whose "srx/raw" node holds the runs. Requests are handled
+    in-process, so no network access is needed.
+    """
+    tree = MapAdapter(
+        {
+            "srx": MapAdapter(
+                {
+                    "raw": MapAdapter(
+                        runs, specs=[Spec("CatalogOfBlueskyRuns", version="1.0")]
+                    )
+                }
+            )
+        }
+    )
+    return from_context(Context.from_app(build_app(tree)))
@@ -0,0 +1,219 @@
+import contextvars
+import functools
+import hashlib
+import io
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from prefect.logging import get_logger
+
+# Directory of the on-disk cache of Tiled array reads, e.g. a volume mounted
+# next to /srv so that it is kept between flow runs. The cache is disabled
+# unless this is set.
+CHUNK_CACHE_DIR = os.environ.get("SRX_CHUNK_CACHE_DIR")
+
+# Byte budget of the cache; the least recently used entries are removed when
+# it is exceeded, down to CHUNK_CACHE_LOW_WATER of it.
+CHUNK_CACHE_BYTES = int(float(os.environ.get("SRX_CHUNK_CACHE_GIB", "50")) * 2**30)
+CHUNK_CACHE_LOW_WATER = 0.9
+
+# Reads larger than this are not cached (and are read from Tiled as usual).
+CHUNK_CACHE_MAX_ITEM_BYTES = 2**30
+
+# Length of the sha256 digest stored after the data of each entry.
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+# Counters of the innermost cache_reads() block of the current context.
+_read_stats = contextvars.ContextVar("chunk_cache_read_stats", default=None)
+
+logger = get_logger(__name__)
+
+
+class ChunkCache:
+    """
+    Size-bounded on-disk LRU cache of arrays, shared by processes.
+
+    Each entry is an .npy file followed by the sha256 digest of its content,
+    which is checked on every read; an entry that does not match is removed
+    and counts as a miss. Files are written to a temporary name and renamed,
+    and their modification time is updated on every hit, so the processes
+    sharing the directory see complete entries and evict by last use.
+    """
+
+    def __init__(self, directory, max_bytes=CHUNK_CACHE_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.corrupt = 0
+        self.evicted = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._size = sum(path.stat().st_size for path in self._entries())
+
+    def _entries(self):
+        return self.directory.glob("*/*.npy")
+
+    def _path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.directory / digest[:2] / f"{digest}.npy"
+
+    def get(self, key):
+        """Return the array cached under key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            content = None
+        array = None
+        if content is not None:
+            body, digest = content[:-DIGEST_SIZE], content[-DIGEST_SIZE:]
+            if hashlib.sha256(body).digest() == digest:
+                array = np.load(io.BytesIO(body), allow_pickle=False)
+            else:
+                logger.warning(f"Removing corrupt chunk cache entry {path}")
+                path.unlink(missing_ok=True)
+                with self._lock:
+                    self.corrupt += 1
+                    self._size -= len(content)
+        with self._lock:
+            if array is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += array.nbytes
+        return array
+
+    def put(self, key, array):
+        """Store array under key, evicting old entries past the byte budget."""
+        if array.dtype.hasobject or array.nbytes > CHUNK_CACHE_MAX_ITEM_BYTES:
+            return
+        buffer = io.BytesIO()
+        np.save(buffer, array, allow_pickle=False)
+        body = buffer.getvalue()
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f".{path.stem}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+                f.write(hashlib.sha256(body).digest())
+            os.replace(tmp_path, path)
+        except OSError:
+            # The cache is an optimization: a full or read-only volume must
+            # not fail the read.
+            tmp_path.unlink(missing_ok=True)
+            logger.exception(f"Could not write chunk cache entry {path}")
+            return
+        with self._lock:
+            self._size += len(body) + DIGEST_SIZE
+            evict = self._size > self.max_bytes
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries down to the low-water mark."""
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        evicted = 0
+        for _, nbytes, path in entries:
+            if size <= self.max_bytes * CHUNK_CACHE_LOW_WATER:
+                break
+            path.unlink(missing_ok=True)
+            size -= nbytes
+            evicted += 1
+        with self._lock:
+            self._size = size
+            self.evicted += evicted
+
+    def info(self):
+        with self._lock:
+            reads = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / reads if reads else None,
+                "bytes_saved": self.bytes_saved,
+                "corrupt": self.corrupt,
+                "evicted": self.evicted,
+                "size": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+@functools.cache
+def get_chunk_cache():
+    """Return the process-wide chunk cache, or None if it is not enabled."""
+    if not CHUNK_CACHE_DIR:
+        return None
+    return ChunkCache(CHUNK_CACHE_DIR)
+
+
+def chunk_cache_info():
+    """Return the counters of the process-wide chunk cache, or None."""
+    cache = get_chunk_cache()
+    return cache.info() if cache is not None else None
+
+
+@contextmanager
+def cache_reads():
+    """
+    Count the chunk cache reads made in this context for the duration of the
+    block.
+
+    Yields a dict with the number of "hits" and "misses" and the
+    "bytes_saved" by the hits. Nested blocks also count towards the outer
+    ones.
+    """
+    outer = _read_stats.get()
+    stats = {"hits": 0, "misses": 0, "bytes_saved": 0}
+    token = _read_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _read_stats.reset(token)
+        if outer is not None:
+            for name, value in stats.items():
+                outer[name] += value
+
+
+def read_array(array_client, slice=None):
+    """
+    Read a slice of a Tiled array, through the chunk cache if it is enabled.
+
+    Entries are keyed by the array's URI (i.e. its run, stream and key), the
+    slice and the current shape and dtype of the array, so the reads of a
+    run that is still growing are not served from an older entry.
+    """
+    cache = get_chunk_cache()
+    if cache is None:
+        return array_client.read(slice=slice)
+    key = (
+        f"{array_client.uri}?slice={slice!r}"
+        f"&shape={tuple(array_client.shape)}&dtype={array_client.dtype.str}"
+    )
+    array = cache.get(key)
+    stats = _read_stats.get()
+    if array is None:
+        array = np.asarray(array_client.read(slice=slice))
+        cache.put(key, array)
+        if stats is not None:
+            stats["misses"] += 1
+    elif stats is not None:
+        stats["hits"] += 1
+        stats["bytes_saved"] += array.nbytes
+    return array
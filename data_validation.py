@@ -1,11 +1,48 @@
+import contextvars
+import functools
+import hashlib
+import json
+import math
+import numbers
 import os
+import threading
 import time as ttime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+import httpx
+import numpy as np
 from prefect import task, flow, get_run_logger
+from prefect.artifacts import create_table_artifact
 from tiled.client import from_uri
 from dotenv import load_dotenv
 
+from atomic_output import atomic_write
+from chunk_cache import read_array
 
+TILED_URI = "https://tiled.nsls2.bnl.gov"
+
+# Root of the proposal directories the exporters write to. It can be
+# overridden, e.g. to run the exporters against a scratch directory.
+PROPOSALS_DIR = os.environ.get("SRX_PROPOSALS_DIR", "/nsls2/data/srx/proposals")
+
+# Run handles are cached per process so that the sub-flows of one
+# end_of_run_workflow share a single lookup of the same run.
+RUN_CACHE_MAXSIZE = 32
+RUN_CACHE_TTL = 300  # seconds
+
+# Upper bound on the data held in memory at once by a streaming validation.
+VALIDATION_MEMORY_BYTES = 256 * 2**20
+
+_client_lock = threading.Lock()
+_tiled_clients = {}
+
+# Counters of the innermost tiled_requests() block of the current context.
+_request_stats = contextvars.ContextVar("tiled_request_stats", default=None)
+
+
+@functools.cache
 def get_api_key_from_env():
     with open("/srv/container.secret", "r") as secrets:
         load_dotenv(stream=secrets)
@@ -13,12 +50,191 @@ def get_api_key_from_env():
     return api_key
 
 
+def get_tiled_client(api_key=None):
+    """
+    Return the process-wide Tiled client for api_key, creating it on first use.
+
+    The client (and its HTTP connection pool) is kept open for the lifetime of
+    the process instead of being rebuilt for every run lookup.
+    """
+    if not api_key:
+        api_key = get_api_key_from_env()
+    with _client_lock:
+        client = _tiled_clients.get(api_key)
+        if client is None:
+            client = from_uri(TILED_URI, api_key=api_key)
+            _count_requests(client)
+            _tiled_clients[api_key] = client
+    return client
+
+
+def set_tiled_client(client, api_key=None):
+    """
+    Use client for api_key instead of connecting to TILED_URI.
+
+    This lets the flows run against a local Tiled app, e.g. in the benchmarks.
+    """
+    if not api_key:
+        api_key = get_api_key_from_env()
+    _count_requests(client)
+    with _client_lock:
+        _tiled_clients[api_key] = client
+    _run_cache.clear()
+
+
+class _CountingStream(httpx.SyncByteStream):
+    def __init__(self, stream, stats):
+        self._stream = stream
+        self._stats = stats
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self._stats["bytes"] += len(chunk)
+            yield chunk
+
+    def close(self):
+        self._stream.close()
+
+
+def _on_response(response):
+    stats = _request_stats.get()
+    if stats is not None:
+        stats["requests"] += 1
+        response.stream = _CountingStream(response.stream, stats)
+
+
+def _count_requests(client):
+    hooks = client.context.http_client.event_hooks["response"]
+    if _on_response not in hooks:
+        hooks.append(_on_response)
+
+
+@contextmanager
+def tiled_requests():
+    """
+    Count the Tiled requests made in this context for the duration of the block.
+
+    Yields a dict with the number of "requests" and the "bytes" received (as
+    sent over the wire, i.e. possibly compressed). Requests made by other
+    threads, e.g. concurrent exporters, are not counted unless they run in a
+    copy of this context. Nested blocks also count towards the outer ones.
+    """
+    outer = _request_stats.get()
+    stats = {"requests": 0, "bytes": 0}
+    token = _request_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _request_stats.reset(token)
+        if outer is not None:
+            outer["requests"] += stats["requests"]
+            outer["bytes"] += stats["bytes"]
+
+
+def get_catalog(api_key=None):
+    """Return the SRX raw-data catalog from the process-wide Tiled client."""
+    return get_tiled_client(api_key)["srx/raw"]
+
+
+class RunCache:
+    """
+    Thread-safe LRU cache of run handles with a time-to-live.
+
+    Each run is stored under both its uid and its scan_id, so a lookup by
+    either reference hits the same entry. Relative (non-positive) scan_ids are
+    never cached.
+    """
+
+    def __init__(self, maxsize=RUN_CACHE_MAXSIZE, ttl=RUN_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and ttime.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, keys, run):
+        now = ttime.monotonic()
+        with self._lock:
+            for key in keys:
+                self._entries[key] = (now, run)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+            }
+
+
+_run_cache = RunCache()
+
+
+def run_cache_info():
+    """Return the hit/miss counters of the process-wide run cache."""
+    return _run_cache.info()
+
+
+def _is_cacheable(ref):
+    # Non-positive scan_ids are relative lookups and must not be cached.
+    return isinstance(ref, str) or (isinstance(ref, numbers.Integral) and ref > 0)
+
+
+def _cache_key(api_key, ref):
+    if isinstance(ref, str):
+        return (api_key, "uid", ref)
+    return (api_key, "scan_id", int(ref))
+
+
 @task
-def get_run(uid, api_key=None):
+def get_run(uid, api_key=None, refresh=False):
+    """
+    Return the run for uid (a uid or a scan_id), using the run cache.
+
+    refresh=True fetches the run again, e.g. to see the stop document of a run
+    that was still in progress when it was cached.
+    """
     if not api_key:
         api_key = get_api_key_from_env()
-    tiled_client = from_uri("https://tiled.nsls2.bnl.gov", api_key=api_key)
-    run = tiled_client["srx/raw"][uid]
+    cacheable = _is_cacheable(uid)
+    if cacheable and not refresh:
+        run = _run_cache.get(_cache_key(api_key, uid))
+        if run is not None:
+            return run
+    run = get_catalog(api_key)[uid]
+    if cacheable:
+        _run_cache.put(
+            [
+                _cache_key(api_key, uid),
+                _cache_key(api_key, run.start["uid"]),
+                _cache_key(api_key, run.start["scan_id"]),
+            ],
+            run,
+        )
     return run
 
 
@@ -27,12 +243,155 @@ def read_stream(run, stream):
     return run[stream].read()
 
 
+def _throughput(nbytes, seconds):
+    return nbytes / 2**20 / seconds if seconds > 0 else None
+
+
+def validate_array(array_client, chunk_bytes=VALIDATION_MEMORY_BYTES):
+    """
+    Read an array in blocks of rows and return a summary of the read.
+
+    At most chunk_bytes (or one row, if a row is larger) is held in memory at
+    a time. The summary contains the shape, dtype, bytes read, number of
+    chunks, elapsed time, throughput in MB/s and a BLAKE2b checksum of the
+    data in C order.
+    """
+    shape = tuple(array_client.shape)
+    dtype = array_client.dtype
+    checksum = hashlib.blake2b()
+    nbytes = 0
+    chunks = 0
+
+    start_time = ttime.monotonic()
+    if len(shape) == 0:
+        blocks = [read_array(array_client)]
+    else:
+        row_bytes = max(math.prod(shape[1:]) * dtype.itemsize, 1)
+        chunk_rows = max(chunk_bytes // row_bytes, 1)
+        blocks = (
+            read_array(array_client, slice(start, start + chunk_rows))
+            for start in range(0, shape[0], chunk_rows)
+        )
+    for block in blocks:
+        contiguous = np.ascontiguousarray(block)
+        checksum.update(contiguous.data)
+        nbytes += contiguous.nbytes
+        chunks += 1
+    elapsed_time = ttime.monotonic() - start_time
+
+    return {
+        "shape": list(shape),
+        "dtype": dtype.str,
+        "bytes": nbytes,
+        "chunks": chunks,
+        "seconds": elapsed_time,
+        "mb_per_s": _throughput(nbytes, elapsed_time),
+        "checksum": checksum.hexdigest(),
+    }
+
+
+def validate_stream(
+    stream_client, max_memory_bytes=VALIDATION_MEMORY_BYTES, max_workers=1
+):
+    """
+    Validate every array key of a stream without reading the whole stream.
+
+    Up to max_workers keys are read concurrently; the memory ceiling is split
+    evenly between them.
+    """
+    data = stream_client["data"]
+    keys = list(data)
+    chunk_bytes = max(max_memory_bytes // max(max_workers, 1), 1)
+
+    def validate_key(key):
+        array_client = data[key]
+        if array_client.structure_family != "array":
+            return {"skipped": f"structure family {array_client.structure_family}"}
+        return validate_array(array_client, chunk_bytes=chunk_bytes)
+
+    start_time = ttime.monotonic()
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        results = dict(zip(keys, executor.map(validate_key, keys)))
+    elapsed_time = ttime.monotonic() - start_time
+    nbytes = sum(result.get("bytes", 0) for result in results.values())
+    return {
+        "bytes": nbytes,
+        "chunks": sum(result.get("chunks", 0) for result in results.values()),
+        "seconds": elapsed_time,
+        "mb_per_s": _throughput(nbytes, elapsed_time),
+        "keys": results,
+    }
+
+
+def _report_table(report):
+    rows = []
+    for stream, stream_report in report["streams"].items():
+        for key, result in stream_report["keys"].items():
+            mb_per_s = result.get("mb_per_s")
+            rows.append(
+                {
+                    "stream": stream,
+                    "key": key,
+                    "bytes": result.get("bytes"),
+                    "chunks": result.get("chunks"),
+                    "seconds": round(result.get("seconds", 0), 3),
+                    "MB/s": None if mb_per_s is None else round(mb_per_s, 1),
+                    "checksum": result.get("checksum", result.get("skipped")),
+                }
+            )
+    return rows
+
+
 @flow
-def data_validation(uid, api_key=None):
+def data_validation(
+    uid,
+    api_key=None,
+    streaming=False,
+    max_memory_bytes=VALIDATION_MEMORY_BYTES,
+    max_workers=1,
+    report_path=None,
+):
+    """
+    Read every stream of a run and log how long it took.
+
+    With streaming=True each array key is read in chunks that keep the data
+    in memory below max_memory_bytes, with up to max_workers keys read
+    concurrently. A per-key report (bytes, chunks, time, MB/s, checksum) is
+    published as a Prefect table artifact, written to report_path as JSON if
+    given, and returned.
+    """
     logger = get_run_logger()
     run = get_run(uid, api_key=api_key)
     logger.info(f"Validating uid {run.start['uid']}")
     start_time = ttime.monotonic()
+
+    if streaming:
+        report = {"uid": run.start["uid"], "streams": {}}
+        for stream in run:
+            stream_report = validate_stream(
+                run[stream], max_memory_bytes=max_memory_bytes, max_workers=max_workers
+            )
+            report["streams"][stream] = stream_report
+            logger.info(
+                f"{stream}: {stream_report['bytes']:_} bytes in "
+                f"{stream_report['chunks']} chunks, "
+                f"elapsed_time = {stream_report['seconds']}"
+            )
+        elapsed_time = ttime.monotonic() - start_time
+        report["bytes"] = sum(s["bytes"] for s in report["streams"].values())
+        report["seconds"] = elapsed_time
+        report["mb_per_s"] = _throughput(report["bytes"], elapsed_time)
+        logger.info(f"{elapsed_time = }")
+
+        create_table_artifact(
+            table=_report_table(report),
+            description=f"Data validation of {run.start['uid']}",
+        )
+        if report_path:
+            with atomic_write(report_path) as f:
+                json.dump(report, f, indent=2)
+        return report
+
     for stream in run:
         logger.info(f"{stream}:")
         stream_start_time = ttime.monotonic()
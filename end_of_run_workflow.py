@@ -1,18 +1,110 @@
+import contextvars
+import functools
+import time as ttime
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from prefect import task, flow, get_run_logger
-from prefect.blocks.notifications import SlackWebhook
 from prefect.context import FlowRunContext
 from prefect.settings import PREFECT_UI_URL
 
-from xanes_exporter import xanes_exporter
-from xrf_hdf5_exporter import xrf_hdf5_exporter
-from vlm_snapshot_exporter import vlm_image_exporter
+from xanes_exporter import is_xanes_run, xanes_exporter
+from xrf_hdf5_exporter import is_xrf_map, xrf_hdf5_exporter
+from vlm_snapshot_exporter import has_vlm_snapshots, vlm_image_exporter
 from logscan import logscan
-from data_validation import get_run
+from chunk_cache import chunk_cache_info
+from data_validation import get_run, run_cache_info
+from notifications import notifier
 
 CATALOG_NAME = "srx"
 
+# Number of exporters run at the same time by end_of_run_workflow.
+# Use max_workers=1 to run them one after another.
+MAX_EXPORTER_WORKERS = 4
+
+# Exporters run by end_of_run_workflow: name -> (flow, predicate, options).
+# The predicate is called with the start document and the list of streams of
+# the run, fetched once, and decides whether the exporter applies to the run.
+# options are the keyword arguments of end_of_run_workflow passed on to the
+# flow, besides api_key.
+EXPORTERS = {
+    "xanes_exporter": (xanes_exporter, is_xanes_run, ("dry_run", "force")),
+    "xrf_hdf5_exporter": (xrf_hdf5_exporter, is_xrf_map, ("dry_run", "force")),
+    "vlm_image_exporter": (vlm_image_exporter, has_vlm_snapshots, ("force",)),
+    "logscan": (logscan, lambda start, streams: True, ("dry_run",)),
+}
+
+
+class ExporterError(Exception):
+    """Raised when one or more exporters of end_of_run_workflow failed."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        details = "; ".join(
+            f"{name}: {type(exc).__name__}: {exc}" for name, exc in failures.items()
+        )
+        super().__init__(f"{len(failures)} exporter(s) failed: {details}")
+
+
+class BatchError(Exception):
+    """Raised when the export of one or more runs of end_of_run_batch failed."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        details = "; ".join(
+            f"{uid}: {type(exc).__name__}: {exc}" for uid, exc in failures.items()
+        )
+        super().__init__(f"{len(failures)} run(s) failed: {details}")
+
+
+@contextmanager
+def run_status(stop_doc, api_key=None):
+    """
+    Send the Slack messages of one bluesky run around the block exporting it.
+
+    Sends a message to mon-bluesky if the bluesky-run failed, then the status
+    of the block: to mon-prefect-srx, and to mon-prefect and mon-prefect-im if
+    it raised. Exceptions of the block are re-raised.
+    """
+    flow_run = FlowRunContext.get().flow_run
+    flow_run_name = flow_run.dict().get("name")
+
+    # Get the uid.
+    uid = stop_doc["run_start"]
+
+    # Get the scan_id.
+    run = get_run(uid, api_key=api_key)
+    scan_id = run.start["scan_id"]
+
+    # Send a message to mon-bluesky if bluesky-run failed.
+    if stop_doc.get("exit_status") == "fail":
+        notifier.notify(
+            "mon-bluesky",
+            f":bangbang: {CATALOG_NAME} bluesky-run failed. (*{flow_run_name}*)\n ```run_start: {uid}\nscan_id: {scan_id}``` ```reason: {stop_doc.get('reason', 'none')}```",
+        )
+
+    try:
+        yield run
+
+        # Send a message to mon-prefect-srx if flow-run is successful.
+        message = f":white_check_mark: {CATALOG_NAME} flow-run successful. (*{flow_run_name}*)\n ```run_start: {uid}\nscan_id: {scan_id}```"
+        notifier.notify_success("mon-prefect-srx", message)
+    except Exception as e:
+        tb = traceback.format_exception_only(e)
+
+        # Send a message to mon-prefect-srx, mon-prefect if flow-run failed.
+        message = f":bangbang: {CATALOG_NAME} flow-run failed. (*{flow_run_name}*)\n ```run_start: {uid}\nscan_id: {scan_id}``` ```{tb[-1]}```"
+        notifier.notify("mon-prefect", message)
+        notifier.notify("mon-prefect-srx", message)
+        # Add link to flow-run for the message to mon-prefect-im.
+        program_message = (
+            f":bangbang: {CATALOG_NAME} flow-run failed. <{PREFECT_UI_URL.value()}/flow-runs/"
+            + f"flow-run/{flow_run.id}|the flow run link> (*{flow_run_name}*)\n ```run_start: {uid}\nscan_id: {scan_id}``` ```{tb[-1]}```"
+        )
+        notifier.notify("mon-prefect-im", program_message)
+        raise
+
 
 def slack(func):
     """
@@ -20,55 +112,34 @@ def slack(func):
     Send a message to mon-prefect-srx slack channel with the flow-run status.
     Send a message to mon-bluesky slack channel if the bluesky-run failed.
 
+    Messages are sent from a background thread (notifications.notifier), which
+    is flushed before the flow-run returns. Success messages are combined into
+    a periodic digest if SRX_SLACK_DIGEST_INTERVAL is set. See run_status.
+
     NOTE: the name of this inner function is the same as the real end_of_workflow() function because
     when the decorator is used, Prefect sees the name of this inner function as the name of
     the flow. To keep the naming of workflows consistent, the name of this inner function had to match the expected name.
     """
 
-    def end_of_run_workflow(stop_doc, api_key=None, dry_run=False):
-        flow_run_name = FlowRunContext.get().flow_run.dict().get("name")
-
-        # Load slack credentials that are saved in Prefect.
-        mon_prefect = SlackWebhook.load("mon-prefect")
-        mon_bluesky = SlackWebhook.load("mon-bluesky")
-        mon_prefect_srx = SlackWebhook.load("mon-prefect-srx")
-        mon_prefect_im = SlackWebhook.load("mon-prefect-im")
-
-        # Get the uid.
-        uid = stop_doc["run_start"]
-
-        # Get the scan_id.
-        run = get_run(uid, api_key=api_key)
-        scan_id = run.start["scan_id"]
-
-        # Send a message to mon-bluesky if bluesky-run failed.
-        if stop_doc.get("exit_status") == "fail":
-            mon_bluesky.notify(
-                f":bangbang: {CATALOG_NAME} bluesky-run failed. (*{flow_run_name}*)\n ```run_start: {uid}\nscan_id: {scan_id}``` ```reason: {stop_doc.get('reason', 'none')}```"
-            )
-
+    def end_of_run_workflow(
+        stop_doc,
+        api_key=None,
+        dry_run=False,
+        max_workers=MAX_EXPORTER_WORKERS,
+        force=False,
+    ):
         try:
-            result = func(stop_doc, api_key=api_key, dry_run=dry_run)
-
-            # Send a message to mon-prefect-srx if flow-run is successful.
-            message = f":white_check_mark: {CATALOG_NAME} flow-run successful. (*{flow_run_name}*)\n ```run_start: {uid}\nscan_id: {scan_id}```"
-            mon_prefect_srx.notify(message)
-            return result
-        except Exception as e:
-            tb = traceback.format_exception_only(e)
-
-            # Send a message to mon-prefect-srx, mon-prefect if flow-run failed.
-            message = f":bangbang: {CATALOG_NAME} flow-run failed. (*{flow_run_name}*)\n ```run_start: {uid}\nscan_id: {scan_id}``` ```{tb[-1]}```"
-            mon_prefect.notify(message)
-            mon_prefect_srx.notify(message)
-            flow_run = FlowRunContext.get().flow_run
-            # Add link to flow-run for the message to mon-prefect-im.
-            program_message = (
-                f":bangbang: {CATALOG_NAME} flow-run failed. <{PREFECT_UI_URL.value()}/flow-runs/"
-                + f"flow-run/{flow_run.id}|the flow run link> (*{flow_run_name}*)\n ```run_start: {uid}\nscan_id: {scan_id}``` ```{tb[-1]}```"
-            )
-            mon_prefect_im.notify(program_message)
-            raise
+            with run_status(stop_doc, api_key=api_key):
+                return func(
+                    stop_doc,
+                    api_key=api_key,
+                    dry_run=dry_run,
+                    max_workers=max_workers,
+                    force=force,
+                )
+        finally:
+            # Failures are sent now; a pending digest waits for its interval.
+            notifier.flush(digest=False)
 
     return end_of_run_workflow
 
@@ -76,17 +147,167 @@ def slack(func):
 @task
 def log_completion():
     logger = get_run_logger()
+    logger.info(f"Run cache: {run_cache_info()}")
+    if chunk_cache_info() is not None:
+        logger.info(f"Chunk cache: {chunk_cache_info()}")
     logger.info("Complete")
 
 
-@flow
-@slack
-def end_of_run_workflow(stop_doc, api_key=None, dry_run=False):
+def dispatch_exporters(run, registry=EXPORTERS):
+    """
+    Return the names of the exporters in registry that apply to a run.
+
+    The predicates only see the start document and the stream names, so the
+    run is not fetched again for exporters that would do nothing.
+    """
+    logger = get_run_logger()
+    start_time = ttime.monotonic()
+    start = run.start
+    streams = list(run)
+    selected = []
+    for name, (_, predicate, _) in registry.items():
+        if predicate(start, streams):
+            selected.append(name)
+        else:
+            logger.info(f"Not running {name} on scan {start['scan_id']}")
+    elapsed_time = ttime.monotonic() - start_time
+    logger.info(f"Dispatching {selected} ({elapsed_time = :.3f} s)")
+    return selected
+
+
+def run_exporters(exporters, max_workers=MAX_EXPORTER_WORKERS):
+    """
+    Run independent exporters and collect their failures.
+
+    exporters maps a name to a zero-argument callable. With max_workers > 1 the
+    callables run in a thread pool; each one runs in a copy of the calling
+    context so Prefect still records them as sub-flows of the current flow run.
+    Returns a dict mapping the names of the failed exporters to their exception.
+    """
+    logger = get_run_logger()
+    failures = {}
+
+    if max_workers is None or max_workers <= 1 or len(exporters) <= 1:
+        for name, exporter in exporters.items():
+            try:
+                exporter()
+            except Exception as e:
+                logger.exception(f"{name} failed")
+                failures[name] = e
+        return failures
+
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(exporters)),
+        thread_name_prefix="exporter",
+    ) as executor:
+        futures = {
+            name: executor.submit(contextvars.copy_context().run, exporter)
+            for name, exporter in exporters.items()
+        }
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.exception(f"{name} failed")
+                failures[name] = e
+    return failures
+
+
+def export_run(
+    stop_doc,
+    api_key=None,
+    dry_run=False,
+    max_workers=MAX_EXPORTER_WORKERS,
+    force=False,
+):
+    """
+    Run the exporters that apply to the run of stop_doc.
+
+    Raises ExporterError if any of them failed.
+    """
     uid = stop_doc["run_start"]
+    run = get_run(uid, api_key=api_key)
 
     # data_validation(uid, return_state=True, api_key=api)
-    xanes_exporter(uid, api_key=api_key, dry_run=dry_run)
-    xrf_hdf5_exporter(uid, api_key=api_key, dry_run=dry_run)
-    vlm_image_exporter(uid, api_key=api_key)
-    logscan(uid, api_key=api_key, dry_run=dry_run)
+    options = {"dry_run": dry_run, "force": force}
+    exporters = {}
+    for name in dispatch_exporters(run):
+        exporter, _, names = EXPORTERS[name]
+        kwargs = {option: options[option] for option in names}
+        exporters[name] = functools.partial(exporter, uid, api_key=api_key, **kwargs)
+    failures = run_exporters(exporters, max_workers=max_workers)
+    if failures:
+        raise ExporterError(failures)
+
+
+@flow
+@slack
+def end_of_run_workflow(
+    stop_doc,
+    api_key=None,
+    dry_run=False,
+    max_workers=MAX_EXPORTER_WORKERS,
+    force=False,
+):
+    """
+    Run the exporters of a finished run.
+
+    Exporters skip runs that the export manifest records as already exported
+    with valid outputs; force=True exports them again.
+    """
+    export_run(
+        stop_doc,
+        api_key=api_key,
+        dry_run=dry_run,
+        max_workers=max_workers,
+        force=force,
+    )
+    log_completion()
+
+
+@flow
+def end_of_run_batch(
+    stop_docs,
+    api_key=None,
+    dry_run=False,
+    max_workers=MAX_EXPORTER_WORKERS,
+    force=False,
+):
+    """
+    Run the exporters of several finished runs in one flow run.
+
+    For bursts of short runs (alignment scans, fly-scan series), which would
+    otherwise each pay for a container, a clone of the repository and the
+    imports. The runs share the process-wide Tiled client, run cache and
+    Slack webhooks. They are exported one after another, in the order of their
+    stop documents; a run that appears more than once is exported once, with
+    its last stop document. Each run gets its own Slack status (run_status),
+    and a failed run does not stop the others: BatchError lists the failed
+    runs at the end.
+    """
+    logger = get_run_logger()
+    runs = {stop_doc["run_start"]: stop_doc for stop_doc in stop_docs}
+    logger.info(f"Exporting {len(runs)} runs ({len(stop_docs)} stop documents)")
+    start_time = ttime.monotonic()
+    failures = {}
+    try:
+        for uid, stop_doc in runs.items():
+            try:
+                with run_status(stop_doc, api_key=api_key):
+                    export_run(
+                        stop_doc,
+                        api_key=api_key,
+                        dry_run=dry_run,
+                        max_workers=max_workers,
+                        force=force,
+                    )
+            except Exception as e:
+                logger.exception(f"Run {uid} failed")
+                failures[uid] = e
+    finally:
+        notifier.flush(digest=False)
+    elapsed_time = ttime.monotonic() - start_time
+    logger.info(f"Exported {len(runs)} runs in {elapsed_time:.1f} s")
+    if failures:
+        raise BatchError(failures)
     log_completion()
@@ -0,0 +1,78 @@
+import json
+import os
+from pathlib import Path
+
+from atomic_output import atomic_write
+from logscan import file_lock, get_userdatadir
+
+# Per-run manifests are stored in this sub-folder of the proposal directory.
+MANIFEST_DIRNAME = ".export_manifest"
+
+
+def manifest_path(start):
+    """Return the path of the export manifest of a run."""
+    return Path(get_userdatadir(start)) / MANIFEST_DIRNAME / f"{start['uid']}.json"
+
+
+def _stop_time(run):
+    stop = run.metadata.get("stop")
+    return stop.get("time") if stop else None
+
+
+def load_manifest(start):
+    """Return the manifest entries of a run, keyed by exporter name."""
+    try:
+        with open(manifest_path(start)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def export_is_current(run, exporter, version):
+    """
+    Return True if exporter (at version) already exported this run.
+
+    The recorded export is only trusted if the run's stop time is unchanged
+    and every recorded output still exists with the recorded size.
+    """
+    stop_time = _stop_time(run)
+    if stop_time is None:
+        return False
+    entry = load_manifest(run.start).get(exporter)
+    if not entry or entry.get("version") != version:
+        return False
+    if entry.get("stop_time") != stop_time:
+        return False
+    for path, size in entry.get("outputs", {}).items():
+        try:
+            if os.path.getsize(path) != size:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def record_export(run, exporter, version, outputs=()):
+    """
+    Record that exporter (at version) wrote outputs for this run.
+
+    outputs: paths of the files written; their current sizes are recorded.
+    Runs without a stop document are not recorded.
+    """
+    stop_time = _stop_time(run)
+    if stop_time is None:
+        return
+    path = manifest_path(run.start)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    entry = {
+        "version": version,
+        "stop_time": stop_time,
+        "outputs": {str(output): os.path.getsize(output) for output in outputs},
+    }
+    # Exporters of the same run record concurrently, so the read-modify-write
+    # is done under a lock and the file is replaced atomically.
+    with file_lock(path.parent / ".lock"):
+        manifest = load_manifest(run.start)
+        manifest[exporter] = entry
+        with atomic_write(path) as f:
+            json.dump(manifest, f, indent=2)
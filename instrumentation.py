@@ -0,0 +1,149 @@
+import contextvars
+import fcntl
+import json
+import os
+import time as ttime
+from contextlib import contextmanager
+
+from prefect import get_run_logger
+from prefect.artifacts import create_table_artifact
+from prefect.logging import get_logger
+
+from atomic_output import write_stats
+from chunk_cache import cache_reads, get_chunk_cache
+from data_validation import tiled_requests
+
+# If set, the stage metrics are also appended to this file as JSON lines, one
+# line per stage (e.g. on a shared volume, to compare the stages of a scan
+# type over a whole cycle). They are always logged.
+STAGE_LOG = os.environ.get("SRX_STAGE_LOG")
+
+# Profile of the innermost profile() block of the current context.
+_profile = contextvars.ContextVar("stage_profile", default=None)
+
+logger = get_logger(__name__)
+
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Time a stage of an exporter, e.g. get_run, read, reduce or make_hdf.
+
+    Yields the stage record; set "bytes" (or other fields) on it. The Tiled
+    requests and bytes received in the block are counted. Outside of a
+    profile() block this does nothing. Stages recorded from other threads
+    need to run in a copy of the context (contextvars.copy_context()).
+    """
+    profile = _profile.get()
+    record = {"stage": name, **fields}
+    if profile is None:
+        yield record
+        return
+    start_time = ttime.perf_counter()
+    with tiled_requests() as stats:
+        try:
+            yield record
+        finally:
+            record["seconds"] = ttime.perf_counter() - start_time
+            record["tiled_requests"] = stats["requests"]
+            record["tiled_bytes"] = stats["bytes"]
+            profile["stages"].append(record)
+
+
+def add_stage(name, seconds, **fields):
+    """Record a stage that was timed by the caller."""
+    profile = _profile.get()
+    if profile is not None:
+        profile["stages"].append({"stage": name, "seconds": seconds, **fields})
+
+
+def set_run(run):
+    """Identify the run of the current profile in its metrics."""
+    profile = _profile.get()
+    if profile is not None:
+        start = run.start
+        profile["run"] = {
+            "uid": start["uid"],
+            "scan_id": start.get("scan_id"),
+            "scan_type": start.get("scan", {}).get("type"),
+            "cycle": start.get("cycle"),
+        }
+
+
+def _stage_rows(profile, writes, total):
+    rows = list(profile["stages"])
+    for write in writes:
+        rows.append(
+            {
+                "stage": "write",
+                "path": write["path"],
+                "bytes": write["bytes"],
+                "seconds": write["seconds"],
+            }
+        )
+    rows.append({"stage": "total", **total})
+    return rows
+
+
+def _emit(name, profile, rows):
+    run_logger = get_run_logger()
+    lines = [
+        json.dumps({"exporter": name, **profile["run"], **row}, default=str)
+        for row in rows
+    ]
+    for line in lines:
+        run_logger.info(line)
+    if STAGE_LOG:
+        # One write per profile under a lock, so that the lines of concurrent
+        # exporters do not interleave.
+        with open(STAGE_LOG, "a") as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            f.write("".join(line + "\n" for line in lines))
+
+    columns = ["stage", "seconds", "bytes", "tiled_requests", "tiled_bytes"]
+    table = []
+    for row in rows:
+        cells = {column: row.get(column) for column in columns}
+        cells["seconds"] = round(cells["seconds"], 3)
+        cells["detail"] = row.get("stream") or row.get("path")
+        table.append(cells)
+    scan_id = profile["run"].get("scan_id")
+    create_table_artifact(
+        table=table,
+        description=f"{name} stages" + (f" of scan {scan_id}" if scan_id else ""),
+    )
+
+
+@contextmanager
+def profile(name):
+    """
+    Record the stages of one exporter task.
+
+    Every stage() in the block, and every file written through atomic_output,
+    becomes a row with its duration, bytes and Tiled requests; the total row
+    also has the chunk cache hits and bytes saved, if it is enabled. At the end
+    the rows are logged and appended to STAGE_LOG as JSON lines, and stored
+    as a Prefect table artifact.
+    """
+    current = {"stages": [], "run": {}}
+    token = _profile.set(current)
+    start_time = ttime.perf_counter()
+    try:
+        with write_stats() as writes, tiled_requests() as stats, cache_reads() as cache:
+            yield current
+    finally:
+        _profile.reset(token)
+        total = {
+            "seconds": ttime.perf_counter() - start_time,
+            "tiled_requests": stats["requests"],
+            "tiled_bytes": stats["bytes"],
+        }
+        if get_chunk_cache() is not None:
+            total["cache_hits"] = cache["hits"]
+            total["cache_misses"] = cache["misses"]
+            total["cache_bytes_saved"] = cache["bytes_saved"]
+        try:
+            _emit(name, current, _stage_rows(current, writes, total))
+        except Exception:
+            # The metrics must not fail the export.
+            logger.exception(f"Could not emit the stage metrics of {name}")
@@ -1,76 +1,323 @@
+import bisect
+import fcntl
+import io
+import os
+import struct
+import threading
+import time as ttime
+import weakref
+from contextlib import contextmanager
 from pathlib import Path
 from prefect import flow, task, get_run_logger
+from tiled.queries import Key
 
-from data_validation import get_run
+from atomic_output import append_write, atomic_write, set_group_writable
+from data_validation import PROPOSALS_DIR, get_catalog, get_run
+from instrumentation import add_stage, profile, set_run, stage
 
+# Number of runs requested per page when searching the catalog (Tiled allows
+# at most 300).
+SEARCH_PAGE_SIZE = 300
 
-def find_scanid(logfile_path, scanid):
-    is_scanid = False
-    with open(logfile_path) as lf:
-        for line in lf:
-            params = line.strip().split("\t")
-            if int(params[0]) == scanid:
-                is_scanid = True
+# Record of the scan id index of a logfile: a scan id, the logfile offset
+# after its line and the logfile's mtime when the line was indexed. The first
+# record holds the logfile's inode, the time the index was built and
+# INDEX_FORMAT instead; an index with another format is rebuilt.
+INDEX_RECORD = struct.Struct("<qqq")
+INDEX_FORMAT = 2
+
+# Bytes before the last indexed offset that are read to check that the last
+# indexed line is still in place, when the logfile has grown since.
+INDEX_CHECK_BYTES = 4096
+
+# Indexes read by this process: index path -> (header, bytes read, last
+# record, sorted scan ids).
+_indexes = {}
+
+# fcntl locks are held per process, so threads of one process also need to
+# take a lock of their own for the path before the file lock. The locks are
+# dropped once no thread uses them.
+_thread_locks = weakref.WeakValueDictionary()
+_thread_locks_lock = threading.Lock()
+
+
+def _sidecar_path(logfile_path, suffix):
+    logfile_path = Path(logfile_path)
+    return logfile_path.with_name(f".{logfile_path.name}.{suffix}")
+
+
+def _thread_lock(path):
+    key = os.path.realpath(path)
+    with _thread_locks_lock:
+        lock = _thread_locks.get(key)
+        if lock is None:
+            lock = _thread_locks[key] = threading.Lock()
+    return lock
+
+
+@contextmanager
+def file_lock(path, mode="a", remove=False, shared=False):
+    """
+    Hold an exclusive lock on path for the duration of the block.
+
+    The lock file is created if needed, and opened with mode ("a" or "a+b")
+    for the block to use. POSIX (fcntl) locks are used because they are
+    honoured across NFS clients.
+
+    With remove=True the lock file is removed at the end of the block, while
+    it is still locked. A process that was waiting on the removed file finds
+    that path no longer refers to it and locks the current file instead.
+    With shared=True other processes can hold a shared lock at the same time
+    (the file must be opened for reading, e.g. with mode "rb").
+    """
+    with _thread_lock(path):
+        while True:
+            lock_file = open(path, mode)
+            # Lock the whole file, wherever the block moves its position to.
+            fcntl.lockf(
+                lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX, 0, 0, os.SEEK_SET
+            )
+            try:
+                current = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path))
+            except FileNotFoundError:
+                current = False
+            if current:
                 break
-    return is_scanid
+            lock_file.close()
+        with lock_file:
+            try:
+                yield lock_file
+            finally:
+                if remove:
+                    Path(path).unlink(missing_ok=True)
+                fcntl.lockf(lock_file, fcntl.LOCK_UN, 0, 0, os.SEEK_SET)
 
 
-@task
-def logscan_detailed(scanid, api_key=None, dry_run=False):
-    logger = get_run_logger()
+def _parse_index_records(data, offset, mtime_ns):
+    # One (scan id, offset after the line, mtime) record per complete line of
+    # data, which starts at offset in the logfile. A partially written last
+    # line is left for the next check.
+    records = []
+    for line in io.BytesIO(data[: data.rfind(b"\n") + 1]):
+        offset += len(line)
+        params = line.decode().strip().split("\t")
+        if params[0]:
+            records.append((int(params[0]), offset, mtime_ns))
+    return records
+
+
+def _read_index_records(f, start, stop):
+    if stop <= start:
+        return []
+    f.seek(start)
+    return list(INDEX_RECORD.iter_unpack(f.read(stop - start)))
+
+
+def _index_is_current(lf, stat, last):
+    # The logfile may only have been appended to since the last record: it
+    # then has the size and mtime of the record, or it is longer and the last
+    # indexed line still ends at the recorded offset. Anything else (an edit
+    # or rewrite in place) requires a rebuild.
+    if last is None:
+        return True
+    scan_id, offset, mtime_ns = last
+    if offset >= stat.st_size:
+        return offset == stat.st_size and mtime_ns == stat.st_mtime_ns
+    start = max(offset - INDEX_CHECK_BYTES, 0)
+    lf.seek(start)
+    data = lf.read(offset - start)
+    if not data.endswith(b"\n"):
+        return False
+    line = data[:-1].rsplit(b"\n", 1)[-1]
+    try:
+        return int(line.decode().strip().split("\t")[0]) == scan_id
+    except ValueError:
+        return False
+
+
+def _scanid_index(f, index_path, logfile_path, update):
+    # f is the locked index file, or None if there is no index. With
+    # update=False nothing is written: a rebuild and the lines that are not
+    # indexed yet are parsed in memory.
+    stat = os.stat(logfile_path)
+    header, size, last, scan_ids = [], 0, None, []
+    if f is not None:
+        size = f.seek(0, os.SEEK_END)
+        # Ignore a record that was only partly written.
+        size -= size % INDEX_RECORD.size
+        header = _read_index_records(f, 0, min(size, INDEX_RECORD.size))
+        key = os.path.realpath(index_path)
+        cached_header, read_size, last, scan_ids = _indexes.get(
+            key, (None, INDEX_RECORD.size, None, [])
+        )
+        if header != cached_header:
+            # Not read by this process yet, or rebuilt by another one.
+            read_size, last, scan_ids = INDEX_RECORD.size, None, []
+        records = _read_index_records(f, read_size, size)
+        if records:
+            last = records[-1]
+            scan_ids = sorted(scan_ids + [record[0] for record in records])
+        _indexes[key] = (header, size, last, scan_ids)
+
+    with open(logfile_path, "rb") as lf:
+        if (
+            not header
+            or header[0][0] != stat.st_ino
+            or header[0][2] != INDEX_FORMAT
+            or not _index_is_current(lf, stat, last)
+        ):
+            last, scan_ids = None, []
+            if update:
+                if not header:
+                    set_group_writable(index_path)
+                header = [(stat.st_ino, ttime.time_ns(), INDEX_FORMAT)]
+                f.truncate(0)
+                f.write(INDEX_RECORD.pack(*header[0]))
+                size = INDEX_RECORD.size
+
+        offset = last[1] if last is not None else 0
+        if offset < stat.st_size:
+            # Only up to the size that was stat'ed, so that the mtime of the
+            # records matches their offset.
+            lf.seek(offset)
+            new_records = _parse_index_records(
+                lf.read(stat.st_size - offset), offset, stat.st_mtime_ns
+            )
+            if new_records:
+                scan_ids = sorted(scan_ids + [record[0] for record in new_records])
+                if update:
+                    f.truncate(size)
+                    f.write(
+                        b"".join(INDEX_RECORD.pack(*record) for record in new_records)
+                    )
+                    size += len(new_records) * INDEX_RECORD.size
+                    last = new_records[-1]
+    if update:
+        _indexes[key] = (header, size, last, scan_ids)
+    return scan_ids
+
+
+def load_scanid_index(logfile_path, update=True):
+    """
+    Return the sorted scan ids recorded in a logfile.
+
+    The ids are kept in a sidecar index (.logfile<session>.txt.idx) that is
+    only appended to: a header with the logfile's inode, then one fixed-size
+    record per line with its scan id, the logfile offset after it and the
+    logfile's mtime. A process reads the index once and then only the records
+    added since, and the lines appended to the logfile after the last record
+    are parsed and added to the index. If the logfile was replaced, truncated
+    or changed in place (its mtime changed without it growing, or the last
+    indexed line is no longer where it was), the index is rebuilt from the
+    whole file. An edit that also grows the file and leaves the last indexed
+    line in place is taken for an append; checking for it would mean reading
+    the whole file. merge_logfile replaces the logfile rather than edit it.
+
+    With update=False, e.g. for dry runs, the index is only read if it
+    exists, and nothing is written to the proposal directory.
+    """
+    index_path = _sidecar_path(logfile_path, "idx")
+    if not update:
+        try:
+            with file_lock(index_path, "rb", shared=True) as f:
+                return _scanid_index(f, index_path, logfile_path, update=False)
+        except FileNotFoundError:
+            return _scanid_index(None, index_path, logfile_path, update=False)
+    try:
+        with file_lock(index_path, "a+b") as f:
+            return _scanid_index(f, index_path, logfile_path, update=True)
+    except OSError:
+        # The index is only a cache of the logfile, e.g. in a directory that
+        # is read-only to this user.
+        return _scanid_index(None, index_path, logfile_path, update=False)
+
+
+def find_scanid(logfile_path, scanid, update=True):
+    scan_ids = load_scanid_index(logfile_path, update=update)
+    i = bisect.bisect_left(scan_ids, scanid)
+    is_scanid = i < len(scan_ids) and scan_ids[i] == scanid
+    return is_scanid
 
-    h = get_run(scanid, api_key=api_key)
 
+def get_userdatadir(start):
     if (
         "Beamline Commissioning (beamline staff only)".lower()
-        in h.start["proposal"]["type"].lower()
+        in start["proposal"]["type"].lower()
     ):
-        userdatadir = (
-            f"/nsls2/data/srx/proposals/commissioning/{h.start['data_session']}/"
-        )
+        userdatadir = f"{PROPOSALS_DIR}/commissioning/{start['data_session']}/"
     else:
-        userdatadir = (
-            f"/nsls2/data/srx/proposals/{h.start['cycle']}/{h.start['data_session']}/"
-        )
+        userdatadir = f"{PROPOSALS_DIR}/{start['cycle']}/{start['data_session']}/"
+    return userdatadir
 
-    if not Path(userdatadir).exists():
-        logger.info(
-            "Incorrect path. Check cycle and proposal id in document. Not running the logger on this document."
-        )
-        return
-
-    logfile_path = userdatadir + f"logfile{h.start['data_session']}.txt"
-    is_scanid = False
-    if Path(logfile_path).exists():
-        is_scanid = find_scanid(logfile_path, h.start["scan_id"])
-
-    if not is_scanid:
-        # Let's build the string
-        #   Each scan should have a scan ID and UID
-        out_str = f"{h.start['scan_id']}\t{h.start['uid']}"
-        #   I don't think the "scan" dictionary is guaranteed with each scan
-        #   I think this is SRX-custom-scan specific
-        if "scan" in h.start:
-            # type probably exists if scan exists, but better to check
-            if "type" in h.start["scan"]:
-                out_str += f"\t{h.start['scan']['type']}"
-                # This is not in every scan type, e.g. peakup
-                if "scan_input" in h.start["scan"]:
-                    out_str += f"\t{h.start['scan']['scan_input']}"
+
+def get_logfile_path(start):
+    return get_userdatadir(start) + f"logfile{start['data_session']}.txt"
+
+
+def format_log_line(start):
+    """Return the logfile line (including the newline) for a start document."""
+    # Build the string
+    #   Each scan should have a scan ID and UID
+    out_str = f"{start['scan_id']}\t{start['uid']}"
+    #   I don't think the "scan" dictionary is guaranteed with each scan
+    #   I think this is SRX-custom-scan specific
+    if "scan" in start:
+        # type probably exists if scan exists, but better to check
+        if "type" in start["scan"]:
+            out_str += f"\t{start['scan']['type']}"
+            # This is not in every scan type, e.g. peakup
+            if "scan_input" in start["scan"]:
+                out_str += f"\t{start['scan']['scan_input']}"
+    else:
+        # We should probably record what the scan was, e.g. count, scan, rel_scan
+        if "plan_name" in start:
+            out_str += f"\t{start['plan_name']}"
         else:
-            # We should probably record what the scan was, e.g. count, scan, rel_scan
-            if "plan_name" in h.start:
-                out_str += f"\t{h.start['plan_name']}"
-            else:
-                out_str += "\tunknown scan"
-        out_str += "\n"
-
-        # Write to file
+            out_str += "\tunknown scan"
+    out_str += "\n"
+    return out_str
+
+
+@task
+def logscan_detailed(scanid, api_key=None, dry_run=False):
+    logger = get_run_logger()
+    with profile("logscan_detailed"):
+        with stage("get_run"):
+            h = get_run(scanid, api_key=api_key)
+        set_run(h)
+
+        userdatadir = get_userdatadir(h.start)
+        if not Path(userdatadir).exists():
+            logger.info(
+                "Incorrect path. Check cycle and proposal id in document. Not running the logger on this document."
+            )
+            return
+
+        logfile_path = get_logfile_path(h.start)
+        out_str = format_log_line(h.start)
+
         if dry_run:
-            logger.info(f"Dry run: scan_id: {h.start['scan_id']} output: {out_str}")
-        else:
-            with open(logfile_path, "a") as userlogf:
-                userlogf.write(out_str)
+            is_scanid = False
+            if Path(logfile_path).exists():
+                is_scanid = find_scanid(logfile_path, h.start["scan_id"], update=False)
+            if not is_scanid:
+                logger.info(f"Dry run: scan_id: {h.start['scan_id']} output: {out_str}")
+            return
+
+        # Check and append under the lock so that concurrent flow runs cannot
+        # interleave lines or add the same scan twice.
+        start_time = ttime.perf_counter()
+        with file_lock(_sidecar_path(logfile_path, "lock")):
+            add_stage("wait_lock", ttime.perf_counter() - start_time)
+            is_scanid = False
+            if Path(logfile_path).exists():
+                with stage("index"):
+                    is_scanid = find_scanid(logfile_path, h.start["scan_id"])
+
+            if not is_scanid:
+                # Write to file
+                with append_write(logfile_path) as userlogf:
+                    userlogf.write(out_str)
                 logger.info(f"Added {h.start['scan_id']} to the logs")
 
 
@@ -80,3 +327,80 @@ def logscan(ref, api_key=None, dry_run=False):
     logger.info("Start writing logfile...")
     logscan_detailed(ref, api_key=api_key, dry_run=dry_run)
     logger.info("Finish writing logfile.")
+
+
+def merge_logfile(logfile_path, lines):
+    """
+    Merge logfile lines into logfile_path and return the number of lines added.
+
+    lines maps scan ids to logfile lines. Lines already in the logfile are
+    kept as they are and take precedence; the merged file is sorted by scan
+    id and replaces the logfile atomically.
+    """
+    logfile_path = Path(logfile_path)
+    with file_lock(_sidecar_path(logfile_path, "lock")):
+        merged = {}
+        if logfile_path.exists():
+            with open(logfile_path) as lf:
+                for line in lf:
+                    params = line.strip().split("\t")
+                    if params[0]:
+                        merged[int(params[0])] = line.rstrip("\n") + "\n"
+        n_existing = len(merged)
+        for scan_id, line in lines.items():
+            merged.setdefault(scan_id, line)
+        if len(merged) == n_existing:
+            return 0
+
+        with atomic_write(logfile_path) as f:
+            f.write("".join(merged[scan_id] for scan_id in sorted(merged)))
+        load_scanid_index(logfile_path)
+    return len(merged) - n_existing
+
+
+@flow(log_prints=True)
+def logscan_backfill(data_session, api_key=None, dry_run=False):
+    """
+    Rebuild the logfile(s) of a data session from the catalog.
+
+    All start documents of the data session are paged through with a single
+    catalog search and merged with the existing logfile in one sorted pass;
+    the lines are formatted exactly as logscan writes them.
+    """
+    logger = get_run_logger()
+    logger.info(f"Backfilling logfile for {data_session}...")
+
+    start_time = ttime.monotonic()
+    results = get_catalog(api_key=api_key).search(
+        Key("start.data_session") == data_session
+    )
+    lines_by_logfile = {}
+    n_runs = 0
+    for _, run in results.items().page_size(SEARCH_PAGE_SIZE):
+        start = run.metadata["start"]
+        if "scan_id" not in start:
+            continue
+        n_runs += 1
+        lines = lines_by_logfile.setdefault(get_logfile_path(start), {})
+        lines.setdefault(start["scan_id"], format_log_line(start))
+    logger.info(
+        f"Found {n_runs} runs for {data_session} in "
+        f"{ttime.monotonic() - start_time:.1f} s"
+    )
+
+    for logfile_path, lines in lines_by_logfile.items():
+        userdatadir = Path(logfile_path).parent
+        if not userdatadir.exists():
+            logger.info(f"Incorrect path {userdatadir}. Not backfilling this logfile.")
+            continue
+        if dry_run:
+            n_missing = len(lines)
+            if Path(logfile_path).exists():
+                scan_ids = set(load_scanid_index(logfile_path, update=False))
+                n_missing = sum(scan_id not in scan_ids for scan_id in lines)
+            logger.info(f"Dry run: would add {n_missing} lines to {logfile_path}")
+            continue
+        n_added = merge_logfile(logfile_path, lines)
+        logger.info(f"Added {n_added} lines to {logfile_path}")
+
+    logger.info(f"Finished backfill in {ttime.monotonic() - start_time:.1f} s")
@@ -0,0 +1,141 @@
+import atexit
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time as ttime
+import urllib.request
+
+from prefect.blocks.notifications import SlackWebhook
+
+# If set, messages are POSTed as JSON ({"channel": ..., "text": ...}) to this
+# URL instead of the Slack webhooks, e.g. to a local HTTP stand-in.
+SLACK_URL = os.environ.get("SRX_SLACK_URL")
+
+# Success messages are combined into one summary per channel every
+# SLACK_DIGEST_INTERVAL seconds. 0 sends each message on its own.
+SLACK_DIGEST_INTERVAL = float(os.environ.get("SRX_SLACK_DIGEST_INTERVAL", "0"))
+
+# Seconds to wait for queued messages to be sent at the end of a flow run.
+SLACK_FLUSH_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+@functools.cache
+def get_webhook(name):
+    """Return the SlackWebhook block saved in Prefect, loading it once."""
+    return SlackWebhook.load(name)
+
+
+def post_message(channel, message):
+    """Send message to channel, synchronously."""
+    if SLACK_URL:
+        request = urllib.request.Request(
+            SLACK_URL,
+            data=json.dumps({"channel": channel, "text": message}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+    else:
+        get_webhook(channel).notify(message)
+
+
+class Notifier:
+    """
+    Send Slack messages from a background thread.
+
+    notify() queues a message and returns at once. notify_success() adds the
+    message to a per-channel digest when digest_interval > 0; the digest is
+    sent every digest_interval seconds and on flush(). Messages that cannot
+    be sent are logged and dropped.
+    """
+
+    def __init__(self, digest_interval=SLACK_DIGEST_INTERVAL, send=post_message):
+        self.digest_interval = digest_interval
+        self.send = send
+        self.sent = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._digest = {}
+        self._digest_time = ttime.monotonic()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="slack-notifier", daemon=True
+                )
+                self._thread.start()
+
+    def notify(self, channel, message):
+        """Queue message to be sent to channel as soon as possible."""
+        self._start()
+        self._queue.put((channel, message))
+
+    def notify_success(self, channel, message):
+        """Queue a success message, to be sent with the digest if enabled."""
+        if self.digest_interval <= 0:
+            self.notify(channel, message)
+            return
+        self._start()
+        with self._lock:
+            self._digest.setdefault(channel, []).append(message)
+
+    def _queue_digest(self, force=False):
+        with self._lock:
+            now = ttime.monotonic()
+            if not force and now - self._digest_time < self.digest_interval:
+                return
+            digest, self._digest = self._digest, {}
+            self._digest_time = now
+        for channel, messages in digest.items():
+            if len(messages) == 1:
+                text = messages[0]
+            else:
+                text = f"{len(messages)} messages:\n" + "\n".join(messages)
+            self._queue.put((channel, text))
+
+    def _run(self):
+        while True:
+            try:
+                channel, message = self._queue.get(timeout=1)
+            except queue.Empty:
+                if self.digest_interval > 0:
+                    self._queue_digest()
+                continue
+            try:
+                self.send(channel, message)
+                self.sent += 1
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Could not send Slack message to {channel}")
+            finally:
+                self._queue.task_done()
+            if self.digest_interval > 0:
+                self._queue_digest()
+
+    def flush(self, timeout=SLACK_FLUSH_TIMEOUT, digest=True):
+        """
+        Wait up to timeout seconds for the queued messages to be sent.
+
+        With digest=True the pending digest is queued first. Returns True if
+        the queue was drained.
+        """
+        if digest:
+            self._queue_digest(force=True)
+        deadline = ttime.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if ttime.monotonic() > deadline:
+                return False
+            ttime.sleep(0.05)
+        return True
+
+
+notifier = Notifier()
+atexit.register(notifier.flush)
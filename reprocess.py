@@ -0,0 +1,263 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time as ttime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from prefect import flow, get_run_logger
+from prefect.logging import get_logger
+from tiled.queries import Key
+
+from atomic_output import atomic_write
+from data_validation import get_catalog, get_run
+from end_of_run_workflow import EXPORTERS
+from logscan import SEARCH_PAGE_SIZE
+
+# Number of processes running exporters in reprocess.
+REPROCESS_WORKERS = 4
+
+# Progress (and the scans/min throughput) is logged every this many scans.
+REPROCESS_LOG_INTERVAL = 10
+
+# Checkpoints of reprocess, one JSON file per selection. They belong to
+# whoever runs reprocess rather than to a proposal, so they are kept out of
+# the proposals tree: by default in the user's state directory, or e.g. in a
+# volume of the worker when running as a deployment.
+REPROCESS_STATE_DIR = os.environ.get(
+    "SRX_REPROCESS_STATE_DIR",
+    os.path.join(
+        os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"),
+        "srx-workflows",
+        "reprocess",
+    ),
+)
+
+
+logger = get_logger(__name__)
+
+
+def selection_name(data_session=None, cycle=None, scan_ids=None):
+    """Return a name for a selection of runs, used for its checkpoint file."""
+    parts = [part for part in (cycle, data_session) if part]
+    if scan_ids:
+        parts.append(f"scans-{scan_ids[0]}-{scan_ids[1]}")
+    return "_".join(parts)
+
+
+def select_runs(api_key=None, data_session=None, cycle=None, scan_ids=None):
+    """
+    Return (scan_id, uid) of the finished runs of a selection, by scan id.
+
+    data_session: e.g. "pass-123456"
+    cycle: e.g. "2025-1"
+    scan_ids: (first, last) range of scan ids, both included
+
+    The criteria that are given are combined. Only start and stop documents
+    are fetched, SEARCH_PAGE_SIZE runs per request.
+    """
+    logger = get_run_logger()
+    results = get_catalog(api_key=api_key)
+    if data_session:
+        results = results.search(Key("start.data_session") == data_session)
+    if cycle:
+        results = results.search(Key("start.cycle") == cycle)
+    if scan_ids:
+        first, last = scan_ids
+        results = results.search(Key("start.scan_id") >= int(first))
+        results = results.search(Key("start.scan_id") <= int(last))
+
+    runs = []
+    for uid, run in results.items().page_size(SEARCH_PAGE_SIZE):
+        start = run.metadata["start"]
+        if "scan_id" not in start:
+            continue
+        if not run.metadata.get("stop"):
+            logger.info(f"Scan {start['scan_id']} has no stop document; skipping it")
+            continue
+        runs.append((start["scan_id"], uid))
+    return sorted(runs)
+
+
+def load_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"runs": {}}
+
+
+def write_state(state_path, state):
+    state_path = Path(state_path)
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_write(state_path) as f:
+        json.dump(state, f, indent=1)
+
+
+def reprocess_run(uid, exporters, api_key=None, dry_run=False, force=False):
+    """
+    Run exporters on one run; called in the worker processes of reprocess.
+
+    Returns (finished, failures): the exporters that ran or do not apply to
+    the run, and a dict mapping the failed ones to their error.
+    """
+    run = get_run.fn(uid, api_key=api_key)
+    start, streams = run.start, list(run)
+    options = {"dry_run": dry_run, "force": force}
+    finished, failures = [], {}
+    for name in exporters:
+        exporter, predicate, names = EXPORTERS[name]
+        try:
+            if predicate(start, streams):
+                kwargs = {option: options[option] for option in names}
+                exporter(uid, api_key=api_key, **kwargs)
+            finished.append(name)
+        except Exception as e:
+            logger.exception(f"{name} failed on {uid}")
+            failures[name] = f"{type(e).__name__}: {e}"
+    return finished, failures
+
+
+@flow(log_prints=True)
+def reprocess(
+    data_session=None,
+    cycle=None,
+    scan_ids=None,
+    exporters=None,
+    api_key=None,
+    dry_run=False,
+    force=False,
+    max_workers=REPROCESS_WORKERS,
+    state_path=None,
+    restart=False,
+):
+    """
+    Run exporters again on every finished run of a data session, a cycle or a
+    scan id range, e.g. after an exporter was fixed.
+
+    exporters: names in end_of_run_workflow.EXPORTERS (default: all of them)
+    scan_ids: (first, last) range of scan ids, both included
+    max_workers: number of processes running the exporters; with 1 the runs
+                 are exported one after another in this process
+
+    Progress is checkpointed to state_path (default: one file per selection
+    in REPROCESS_STATE_DIR) after every run, so an interrupted reprocess
+    resumes where it stopped; runs that failed are tried again. restart=True
+    ignores the checkpoint. force is passed on to the exporters, which
+    otherwise skip the runs recorded in their export manifest.
+    """
+    logger = get_run_logger()
+    name = selection_name(data_session, cycle, scan_ids)
+    if not name:
+        raise ValueError("Select runs by data_session, cycle and/or scan_ids.")
+    exporters = list(exporters or EXPORTERS)
+    unknown = set(exporters) - set(EXPORTERS)
+    if unknown:
+        raise ValueError(f"Unknown exporter(s): {', '.join(sorted(unknown))}")
+    if state_path is None:
+        state_path = os.path.join(REPROCESS_STATE_DIR, f"{name}.json")
+
+    start_time = ttime.monotonic()
+    runs = select_runs(api_key, data_session, cycle, scan_ids)
+    logger.info(
+        f"Found {len(runs)} runs for {name} in {ttime.monotonic() - start_time:.1f} s"
+    )
+
+    state = {"runs": {}} if restart else load_state(state_path)
+    done = state["runs"]
+    todo = [
+        (scan_id, uid)
+        for scan_id, uid in runs
+        if not set(exporters) <= set(done.get(uid, {}).get("finished", []))
+    ]
+    if len(todo) < len(runs):
+        logger.info(f"Resuming from {state_path}: {len(runs) - len(todo)} runs done")
+    logger.info(f"Running {exporters} on {len(todo)} runs")
+    start_time = ttime.monotonic()
+
+    def log_progress(n):
+        minutes = (ttime.monotonic() - start_time) / 60
+        logger.info(
+            f"{n}/{len(todo)} runs in {minutes:.1f} min "
+            f"({n / minutes if minutes else 0:.1f} scans/min)"
+        )
+
+    def finish(n, scan_id, uid, result):
+        try:
+            finished, failures = result()
+        except Exception as e:
+            logger.exception(f"Reprocessing {uid} failed")
+            finished, failures = [], {"reprocess_run": f"{type(e).__name__}: {e}"}
+        entry = done.setdefault(uid, {"scan_id": scan_id, "finished": []})
+        entry["finished"] = sorted(set(entry["finished"]) | set(finished))
+        entry["failures"] = failures
+        if not dry_run:
+            write_state(state_path, state)
+        if n % REPROCESS_LOG_INTERVAL == 0:
+            log_progress(n)
+
+    args = (exporters, api_key, dry_run, force)
+    if max_workers is None or max_workers <= 1:
+        for n, (scan_id, uid) in enumerate(todo, 1):
+            finish(n, scan_id, uid, lambda uid=uid: reprocess_run(uid, *args))
+    else:
+        # Spawn rather than fork: the flow process runs Prefect's threads.
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(reprocess_run, uid, *args): (scan_id, uid)
+                for scan_id, uid in todo
+            }
+            for n, future in enumerate(as_completed(futures), 1):
+                finish(n, *futures[future], future.result)
+    if todo:
+        log_progress(len(todo))
+
+    failed = {
+        scan_id: done[uid]["failures"]
+        for scan_id, uid in runs
+        if done.get(uid, {}).get("failures")
+    }
+    for scan_id, failures in sorted(failed.items()):
+        for exporter, error in failures.items():
+            logger.error(f"Scan {scan_id}: {exporter} failed: {error}")
+    logger.info(f"{len(failed)} of {len(runs)} runs failed; state in {state_path}")
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run SRX exporters again on a data session, cycle or scan range."
+    )
+    parser.add_argument("--data-session", help='e.g. "pass-123456"')
+    parser.add_argument("--cycle", help='e.g. "2025-1"')
+    parser.add_argument("--scan-ids", nargs=2, type=int, metavar=("FIRST", "LAST"))
+    parser.add_argument(
+        "--exporters", nargs="+", choices=list(EXPORTERS), help="default: all"
+    )
+    parser.add_argument("--workers", type=int, default=REPROCESS_WORKERS)
+    parser.add_argument("--state", help="checkpoint file")
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoint")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args(argv)
+
+    failed = reprocess(
+        data_session=args.data_session,
+        cycle=args.cycle,
+        scan_ids=args.scan_ids,
+        exporters=args.exporters,
+        dry_run=args.dry_run,
+        force=args.force,
+        max_workers=args.workers,
+        state_path=args.state,
+        restart=args.restart,
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,63 +1,217 @@
 from prefect import flow, task, get_run_logger
+from prefect.cache_policies import NO_CACHE
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import numpy as np
 import os
-from PIL import Image
-from data_validation import get_run
+from data_validation import PROPOSALS_DIR, get_run
+from export_manifest import export_is_current, record_export
+from atomic_output import atomic_path
+from chunk_cache import read_array
+from instrumentation import profile, set_run, stage
+
+# The camera_snapshot stream holds one snapshot before and one after the scan.
+SNAPSHOT_TITLES = ["before", "after"]
+
+# Number of processes encoding PNGs in vlm_image_batch_exporter.
+PNG_WORKERS = 4
+
+# Number of scans whose frames are held in memory at once in batch mode.
+VLM_BATCH_SIZE = 32
+
+# Bump when the exported files change, so that runs recorded in the export
+# manifest are exported again.
+EXPORTER_VERSION = "1"
 
 
 @flow(log_prints=True)
-def vlm_image_exporter(ref, api_key=None, dry_run=False):
+def vlm_image_exporter(ref, api_key=None, dry_run=False, force=False):
     logger = get_run_logger()
     logger.info("")
 
-    scan_id = get_run(ref, api_key=api_key).start["scan_id"]
+    h = get_run(ref, api_key=api_key)
+    scan_id = h.start["scan_id"]
+    if not force and export_is_current(h, "vlm_image_exporter", EXPORTER_VERSION):
+        logger.info(
+            f"Scan {scan_id} was already exported. Use force=True to export it again."
+        )
+        return
     logger.info(f"Looking for snapshots in scan {scan_id}.")
 
-    export_vlm_image(scan_id, api_key=api_key, dry_run=dry_run)
+    outputs = export_vlm_image(scan_id, api_key=api_key, dry_run=dry_run, run=h)
+    if not dry_run:
+        record_export(h, "vlm_image_exporter", EXPORTER_VERSION, outputs)
     logger.info(f"Finished exporting any snapshots in scan {scan_id}.")
 
 
-@task
+def has_vlm_snapshots(start, streams):
+    """Return True if vlm_image_exporter applies to a run."""
+    return "camera_snapshot" in streams
+
+
+def normalize_images(images):
+    """
+    Normalize a stack of float32 frames to [0, 1] in place.
+
+    Each frame is shifted so that mean - 2 * std maps to 0 and then scaled
+    by its new mean + 2 * std; the statistics are accumulated in float64.
+    """
+    axes = tuple(range(1, images.ndim))
+    mean = images.mean(axis=axes, keepdims=True, dtype=np.float64)
+    std = images.std(axis=axes, keepdims=True, dtype=np.float64)
+    images -= (mean - 2 * std).astype(images.dtype)
+    mean = images.mean(axis=axes, keepdims=True, dtype=np.float64)
+    std = images.std(axis=axes, keepdims=True, dtype=np.float64)
+    images /= (mean + 2 * std).astype(images.dtype)
+    np.clip(images, 0, 1, out=images)
+    return images
+
+
+def to_uint16(images):
+    """Scale normalized frames to the full uint16 range."""
+    images *= 65535
+    return images.astype(np.uint16)
+
+
+def save_png(image, filename):
+    from PIL import Image
+
+    # Return raw png
+    with atomic_path(filename) as tmp_path:
+        Image.fromarray(image).save(tmp_path)
+    return filename
+
+
+def read_vlm_frames(h):
+    """
+    Return the before/after VLM frames of a run as a float32 stack.
+
+    Only the frames that are exported are requested from Tiled. Returns None
+    if the run has no VLM images.
+    """
+    if "camera_snapshot" not in h:
+        return None
+    frames = read_array(
+        h["camera_snapshot"]["data"]["nano_vlm_image"],
+        (slice(None, len(SNAPSHOT_TITLES)), 0),
+    )
+    return np.asarray(frames, dtype=np.float32)
+
+
+def vlm_image_dir(h):
+    proposal_id = h.start["proposal"]["proposal_id"]
+    cycle = h.start["cycle"]
+    wd = f"{PROPOSALS_DIR}/{cycle}/pass-{proposal_id}/"
+
+    # Sub-folder
+    return f"{wd}vlm_snapshots/"
+
+
+def vlm_image_filenames(h, n_frames):
+    wd = vlm_image_dir(h)
+    return [
+        os.path.join(wd, f"scan{h.start['scan_id']}_VLM_image_{title}.png")
+        for title in SNAPSHOT_TITLES[:n_frames]
+    ]
+
+
+@task(cache_policy=NO_CACHE)
 def export_vlm_image(
     scan_id,
     api_key=None,
     dry_run=False,
+    run=None,
 ):
     logger = get_run_logger()
+    with profile("export_vlm_image"):
+        # Initial checks
+        # Does scan exist
+        scan_id = int(scan_id)
+        with stage("get_run"):
+            h = run if run is not None else get_run(scan_id, api_key=api_key)
+        set_run(h)
 
-    # Initial checks
-    # Does scan exist
-    scan_id = int(scan_id)
-    h = get_run(scan_id, api_key=api_key)
+        # VLM image data acquired?
+        with stage("read", stream="camera_snapshot") as record:
+            frames = read_vlm_frames(h)
+            record["bytes"] = 0 if frames is None else frames.nbytes
+        if frames is None:
+            warn_str = f"No VLM images found for scan {scan_id}."
+            logger.info(warn_str)
+            return []
 
-    # VLM image data acquired?
-    if "camera_snapshot" not in h:
-        warn_str = f"No VLM images found for scan {scan_id}."
-        logger.info(warn_str)
-        return
+        # Create sub-folder
+        os.makedirs(vlm_image_dir(h), exist_ok=True)
 
-    proposal_id = h.start["proposal"]["proposal_id"]
-    cycle = h.start["cycle"]
-    wd = f"/nsls2/data/srx/proposals/{cycle}/pass-{proposal_id}/"
-
-    # Create sub-folder
-    wd = f"{wd}vlm_snapshots/"
-    os.makedirs(wd, exist_ok=True)
-
-    images = h["camera_snapshot"]["data"]["nano_vlm_image"][:, 0].astype(np.float64)
-
-    # logger.info('VLM images found; writing images to folder.')
-    for image, title in zip(images, ["before", "after"]):
-        # Normalize
-        image -= image.mean() - 2 * image.std()
-        image /= image.mean() + 2 * image.std()
-        image[image < 0] = 0
-        image[image > 1] = 1
-
-        # Return raw png
-        image = Image.fromarray((image * 65535).astype(np.uint16))
-        filename = os.path.join(wd, f"scan{scan_id}_VLM_image_{title}.png")
-        if dry_run:
-            logger.info(f"Dry run: Not saving image to {filename}")
-        else:
-            image.save(filename)
+        # logger.info('VLM images found; writing images to folder.')
+        with stage("normalize"):
+            images = to_uint16(normalize_images(frames))
+        filenames = vlm_image_filenames(h, len(images))
+        for image, filename in zip(images, filenames):
+            if dry_run:
+                logger.info(f"Dry run: Not saving image to {filename}")
+            else:
+                save_png(image, filename)
+        return [] if dry_run else filenames
+
+
+@flow(log_prints=True)
+def vlm_image_batch_exporter(
+    scan_ids, api_key=None, dry_run=False, max_workers=PNG_WORKERS, force=False
+):
+    """
+    Export the VLM snapshots of many scans, e.g. a whole proposal.
+
+    scan_ids: list (or range) of scan ids
+
+    Frames are read VLM_BATCH_SIZE scans at a time, normalized together in one
+    float32 pass and encoded to PNG in a pool of max_workers processes. Scans
+    recorded as exported in the export manifest are skipped unless force=True.
+    """
+    logger = get_run_logger()
+    scan_ids = [int(scan_id) for scan_id in scan_ids]
+    logger.info(f"Exporting VLM snapshots of {len(scan_ids)} scans.")
+
+    n_written = 0
+    # Spawn rather than fork: the flow process runs Prefect's threads.
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for i in range(0, len(scan_ids), VLM_BATCH_SIZE):
+            # Frames of different shapes cannot be stacked, so they are
+            # grouped by shape and each group is normalized in one pass.
+            groups = {}
+            exported = []
+            for scan_id in scan_ids[i : i + VLM_BATCH_SIZE]:
+                h = get_run(scan_id, api_key=api_key)
+                if not force and export_is_current(
+                    h, "vlm_image_exporter", EXPORTER_VERSION
+                ):
+                    logger.info(f"Scan {scan_id} was already exported.")
+                    continue
+                frames = read_vlm_frames(h)
+                if frames is None:
+                    logger.info(f"No VLM images found for scan {scan_id}.")
+                    exported.append((h, []))
+                    continue
+                os.makedirs(vlm_image_dir(h), exist_ok=True)
+                group = groups.setdefault(frames.shape[1:], ([], []))
+                group[0].append(frames)
+                filenames = vlm_image_filenames(h, len(frames))
+                group[1].extend(filenames)
+                exported.append((h, filenames))
+
+            for frames, filenames in groups.values():
+                images = to_uint16(normalize_images(np.concatenate(frames)))
+                del frames[:]
+                if dry_run:
+                    for filename in filenames:
+                        logger.info(f"Dry run: Not saving image to {filename}")
+                    continue
+                n_written += len(list(executor.map(save_png, images, filenames)))
+
+            if not dry_run:
+                for h, filenames in exported:
+                    record_export(h, "vlm_image_exporter", EXPORTER_VERSION, filenames)
+
+    logger.info(f"Wrote {n_written} VLM images.")
@@ -1,16 +1,199 @@
 from prefect import flow, task, get_run_logger
-from data_validation import get_run
+from data_validation import PROPOSALS_DIR, get_run, tiled_requests
+from export_manifest import export_is_current, record_export
+from logscan import file_lock
+from atomic_output import append_write, atomic_path, atomic_write
+from chunk_cache import read_array
+from instrumentation import profile, set_run, stage
+import contextvars
+import functools
+import json
+import os
+import re
+import threading
 import time as ttime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
-import xraylib as xrl
-import pandas as pd
 from pathlib import Path
 
+# Upper bound on the size of one block of MCA data requested from Tiled when
+# reducing a fly-scan channel to its ROI window.
+ROI_CHUNK_BYTES = 16 * 2**20
+
+# ROI windows of a fly scan closer than this many MCA bins are requested from
+# Tiled as one slice, trading a few extra bins for fewer requests.
+ROI_MERGE_GAP = 64
+
+# xraylib emission lines (attribute names) of the fly-scan ROIs, by the first
+# two letters of the line in the ROI name (e.g. "Fe_ka1"), and the half width
+# of an ROI window in MCA bins (10 eV each) around the line energy.
+XRF_LINES = {
+    "ka": "KA_LINE",
+    "kb": "KB_LINE",
+    "la": "LA_LINE",
+    "lb": "LB_LINE",
+    "ma": "MA1_LINE",
+}
+ROI_HALF_WIDTH = 10
+
+# Number of Tiled requests that xas_fly_exporter has in flight at the same
+# time, over all of its streams and keys.
+FLY_EXPORT_WORKERS = 4
+
+# Bump when the exported files change, so that runs recorded in the export
+# manifest are exported again.
+EXPORTER_VERSION = "2"
+
+# Seconds between two polls of a running XAS step scan by
+# xas_step_live_exporter, and how long it waits for new rows before giving up.
+LIVE_POLL_INTERVAL = 5
+LIVE_IDLE_TIMEOUT = 3600
+
+# Xspress3 keys holding the total counts of an ROI, e.g.
+# xs_channel01_mcaroi02_total_rbv (channel 1, ROI 2).
+XS_ROI_KEY = re.compile(r"mcaroi(\d+).*total_rbv")
+
+# Also write an HDF5 sidecar (.h5 next to each .txt) with the columns at full
+# precision, the ROI sums and the XDI header as attributes. Set
+# SRX_XAS_HDF5_SIDECAR=1 to enable it by default.
+XAS_HDF5_SIDECAR = os.environ.get("SRX_XAS_HDF5_SIDECAR", "").lower() in ("1", "true")
+
+
+def is_xanes_run(start, streams):
+    """Return True if xanes_exporter applies to a run."""
+    return start.get("scan", {}).get("type") in ("XAS_STEP", "XAS_FLY")
+
+
+@functools.cache
+def roi_window(roi_name):
+    """
+    Return the (E_min, E_max) MCA bins of a fly-scan ROI such as "Fe_ka1".
+
+    Returns None if the element or the emission line is not recognized.
+    """
+    import xraylib as xrl
+
+    try:
+        roi_symbol, roi_line = roi_name.split("_")
+        roi_line_ind = getattr(xrl, XRF_LINES[roi_line.lower()[:2]])
+        E = xrl.LineEnergy(xrl.SymbolToAtomicNumber(roi_symbol), roi_line_ind)
+    except (KeyError, ValueError):
+        return None
+    E_bin = np.round(E * 100, decimals=0).astype(int)
+    return E_bin - ROI_HALF_WIDTH, E_bin + ROI_HALF_WIDTH
+
 
 def create_subdir(path):
     Path(path).mkdir(parents=True, exist_ok=True)
 
 
+def hdf5_sidecar_path(filepath):
+    return str(Path(filepath).with_suffix(".h5"))
+
+
+def write_hdf5_sidecar(filepath, header, columns, roi_sums):
+    """
+    Write the HDF5 sidecar of the XAS export filepath and return its path.
+
+    header: the XDI header text. It is stored in the "xdi_header" attribute,
+            and each "# Key: value" line also becomes an attribute (split at
+            the first colon).
+    columns: dict of 1-D arrays, stored in order in the "columns" group
+    roi_sums: dict of 1-D arrays, stored in order in the "roi_sums" group
+    """
+    import h5py
+
+    h5path = hdf5_sidecar_path(filepath)
+    with (
+        atomic_path(h5path) as tmp_path,
+        h5py.File(tmp_path, "w", track_order=True) as f,
+    ):
+        f.attrs["xdi_header"] = header
+        for line in header.splitlines():
+            # Not every header line has a space after the colon, e.g. the
+            # ring current of the step scans.
+            key, sep, value = line.lstrip("# ").partition(":")
+            key = key.strip()
+            if sep and key and key not in f.attrs:
+                f.attrs[key] = value.strip()
+        for name, data in (("columns", columns), ("roi_sums", roi_sums)):
+            group = f.create_group(name, track_order=True)
+            for key, array in data.items():
+                group.create_dataset(key, data=np.asarray(array))
+    return h5path
+
+
+def roi_window_sum(array_client, bin_min, bin_max, chunk_bytes=ROI_CHUNK_BYTES):
+    """
+    Sum the energy bins [bin_min:bin_max] of an MCA array for every point.
+
+    array_client: Tiled array of shape (points, ..., bins)
+    chunk_bytes: upper bound on the size of each block read from Tiled
+
+    Only the energy window is requested from the server, in blocks of rows,
+    so the transferred data and the peak memory scale with the window and the
+    block size rather than with the full spectrum and the scan length.
+    """
+    return roi_window_sums(array_client, [(bin_min, bin_max)], chunk_bytes)[0]
+
+
+def roi_spans(windows, max_gap=ROI_MERGE_GAP):
+    """Merge (bin_min, bin_max) windows less than max_gap bins apart."""
+    spans = []
+    for bin_min, bin_max in sorted(windows):
+        if spans and bin_min <= spans[-1][1] + max_gap:
+            spans[-1][1] = max(spans[-1][1], bin_max)
+        else:
+            spans.append([bin_min, bin_max])
+    return [tuple(span) for span in spans]
+
+
+def roi_window_sums(array_client, windows, chunk_bytes=ROI_CHUNK_BYTES):
+    """
+    Sum several energy windows of an MCA array for every point.
+
+    array_client: Tiled array of shape (points, ..., bins)
+    windows: list of (bin_min, bin_max) windows
+    chunk_bytes: upper bound on the size of each block read from Tiled
+
+    Returns an array of shape (len(windows), points). The array is read once,
+    in blocks of rows: close or overlapping windows are merged into spans
+    (roi_spans) and each span of a block is requested once, whatever the
+    number of windows it holds.
+    """
+    shape = array_client.shape
+    n_points = shape[0]
+    windows = [
+        (max(int(bin_min), 0), min(int(bin_max), shape[-1]))
+        for bin_min, bin_max in windows
+    ]
+    spans = roi_spans(windows)
+    # Index of the span holding each window.
+    window_spans = [
+        next(i for i, (lo, hi) in enumerate(spans) if lo <= bin_min and bin_max <= hi)
+        for bin_min, bin_max in windows
+    ]
+    row_bytes = (
+        max(sum(hi - lo for lo, hi in spans), 1)
+        * int(np.prod(shape[1:-1], dtype=int))
+        * array_client.dtype.itemsize
+    )
+    chunk_rows = max(chunk_bytes // row_bytes, 1)
+    inner = (slice(None),) * (len(shape) - 2)
+
+    sums = [[] for _ in windows]
+    for start in range(0, n_points, chunk_rows):
+        rows = (slice(start, start + chunk_rows),) + inner
+        blocks = [read_array(array_client, rows + (slice(lo, hi),)) for lo, hi in spans]
+        for i, (bin_min, bin_max) in enumerate(windows):
+            lo = spans[window_spans[i]][0]
+            block = blocks[window_spans[i]][..., bin_min - lo : bin_max - lo]
+            sums[i].append(np.sum(block.reshape(block.shape[0], -1), axis=1))
+    if n_points == 0:
+        return np.zeros((len(windows), 0))
+    return np.stack([np.concatenate(window_sums) for window_sums in sums])
+
+
 def xanes_textout(
     scanid=-1,
     header=[],
@@ -20,6 +203,8 @@ def xanes_textout(
     usercolumnname=[],
     output=True,
     api_key=None,
+    hdf5=False,
+    data=None,
 ):
     """
     scan: can be scan_id (integer) or uid (string). default=-1 (last scan run)
@@ -31,102 +216,165 @@ def xanes_textout(
     output: print all header fields. if output = False, only print the ones
             that were able to be written
             default = True
+    hdf5: also write the HDF5 sidecar (see write_hdf5_sidecar)
+    data: the event data already read (e.g. an xarray Dataset), used
+            instead of reading each column from tiled
 
     """
 
     h = get_run(scanid, api_key=api_key)
-    filepath = f"/nsls2/data/srx/proposals/{h.start['cycle']}/{h.start['data_session']}/xas/scan_{h.start['scan_id']}_xanes.txt"  # noqa: E501
+    filepath = xanes_filepath(h.start)
 
     create_subdir(Path(filepath).parent)
 
-    with open(filepath, "w") as f:
-        dataset_client = h["primary"]["data"]
-
-        staticheader = (
-            "# XDI/1.0 MX/2.0\n"
-            + "# Beamline.name: "
-            + h.start["beamline_id"]
-            + "\n"
-            + "# Facility.name: NSLS-II\n"
-            + "# Facility.ring_current:"
-            + str(dataset_client["ring_current"][0])
-            + "\n"
-            + "# Scan.start.uid: "
-            + h.start["uid"]
-            + "\n"
-            + "# Scan.start.time: "
-            + str(h.start["time"])
-            + "\n"
-            + "# Scan.start.ctime: "
-            + ttime.ctime(h.start["time"])
-            + "\n"
-            + "# Mono.name: Si 111\n"
+    dataset_client = h["primary"]["data"]
+
+    if data is None:
+        dataset_keys = dataset_client.keys()
+        file_data = {}
+        for item in column:
+            if item in dataset_keys:
+                # retrieve the data from tiled that is going to be used
+                # in the file
+                file_data[item] = read_array(dataset_client[item])
+        data = file_data
+    else:
+        file_data = {item: np.asarray(data[item]) for item in column if item in data}
+
+    with stage("format"):
+        lines = xanes_header_lines(
+            h,
+            dataset_client,
+            header,
+            userheader,
+            column,
+            file_data,
+            usercolumnname,
+            output,
+            ring_current=np.asarray(data["ring_current"])[0]
+            if "ring_current" in data
+            else None,
+        )
+        rows = format_xdi_rows(
+            [file_data[item] for item in column if item in file_data],
+            [usercolumn[item] for item in usercolumnname if item in usercolumn],
+            n_rows=len(file_data[column[0]]),
         )
+    if hdf5:
+        write_hdf5_sidecar(
+            filepath,
+            "".join(lines),
+            file_data,
+            {item: usercolumn[item] for item in usercolumnname if item in usercolumn},
+        )
+    lines.append(rows)
 
-        f.write(staticheader)
+    with atomic_write(filepath) as f:
+        f.write("".join(lines))
+    return filepath
 
-        for item in header:
-            if item in dataset_client.keys():
-                f.write("# " + item + ": " + str(dataset_client[item]) + "\n")
-                if output is True:
-                    print(f"{item} is written")
-            else:
-                print(f"{item} is not in the scan")
 
-        for key in userheader:
-            f.write("# " + key + ": " + str(userheader[key]) + "\n")
+def xanes_filepath(start):
+    return f"{PROPOSALS_DIR}/{start['cycle']}/{start['data_session']}/xas/scan_{start['scan_id']}_xanes.txt"  # noqa: E501
+
+
+def xanes_header_lines(
+    h,
+    dataset_client,
+    header,
+    userheader,
+    column,
+    present,
+    usercolumnname,
+    output,
+    ring_current=None,
+):
+    """
+    Return the header lines of an XDI file written by xanes_textout.
+
+    present: the items of column found in the event data
+    ring_current: the first ring current reading, if already read
+    """
+    if ring_current is None:
+        ring_current = dataset_client["ring_current"][0]
+    dataset_keys = dataset_client.keys()
+
+    staticheader = (
+        "# XDI/1.0 MX/2.0\n"
+        + "# Beamline.name: "
+        + h.start["beamline_id"]
+        + "\n"
+        + "# Facility.name: NSLS-II\n"
+        + "# Facility.ring_current:"
+        + str(ring_current)
+        + "\n"
+        + "# Scan.start.uid: "
+        + h.start["uid"]
+        + "\n"
+        + "# Scan.start.time: "
+        + str(h.start["time"])
+        + "\n"
+        + "# Scan.start.ctime: "
+        + ttime.ctime(h.start["time"])
+        + "\n"
+        + "# Mono.name: Si 111\n"
+    )
+    lines = [staticheader]
+
+    for item in header:
+        if item in dataset_keys:
+            lines.append("# " + item + ": " + str(dataset_client[item]) + "\n")
             if output is True:
-                print(f"{key} is written")
+                print(f"{item} is written")
+        else:
+            print(f"{item} is not in the scan")
 
-        file_data = {}
-        for idx, item in enumerate(column):
-            if item in dataset_client.keys():
-                # retrieve the data from tiled that is going to be used
-                # in the file
-                file_data[item] = dataset_client[item].read()
-                f.write("# Column." + str(idx + 1) + ": " + item + "\n")
+    for key in userheader:
+        lines.append("# " + key + ": " + str(userheader[key]) + "\n")
+        if output is True:
+            print(f"{key} is written")
 
-        f.write("# ")
-        for item in column:
-            if item in dataset_client.keys():
-                f.write(str(item) + "\t")
-
-        for item in usercolumnname:
-            f.write(item + "\t")
-
-        f.write("\n")
-        f.flush()
-
-        offset = False
-        for idx in range(len(file_data[column[0]])):
-            for item in column:
-                if item in file_data:
-                    f.write("{0:8.6g}  ".format(file_data[item][idx]))
-            for item in usercolumnname:
-                if item in usercolumn:
-                    if offset is False:
-                        try:
-                            f.write("{0:8.6g}  ".format(usercolumn[item][idx]))
-                        except KeyError:
-                            offset = True
-                            f.write("{0:8.6g}  ".format(usercolumn[item][idx + 1]))
-                    else:
-                        f.write("{0:8.6g}  ".format(usercolumn[item][idx + 1]))
-            f.write("\n")
+    for idx, item in enumerate(column):
+        if item in present:
+            lines.append("# Column." + str(idx + 1) + ": " + item + "\n")
 
+    lines.append("# " + "".join(str(item) + "\t" for item in column if item in present))
+    lines.append("".join(item + "\t" for item in usercolumnname) + "\n")
+    return lines
 
-@task
-def xas_step_exporter(scanid, api_key=None, dry_run=False):
-    logger = get_run_logger()
 
-    # Custom header list
-    headeritem = []
-    # Load header for our scan
-    h = get_run(scanid, api_key=api_key)
+def format_xdi_rows(columns, usercolumns=(), n_rows=None):
+    """
+    Format the data block of an XDI file in one pass.
 
-    if h.start["scan"].get("type") != "XAS_STEP":
-        logger.info("Incorrect document type. Not running exporter on this document.")
-        return
+    columns: sequence of 1-D arrays read from the event data
+    usercolumns: sequence of 1-D arrays or pandas Series appended after
+            columns. They are aligned by position, so Series indexed by
+            seq_num (starting at 1) line up with the event data.
+    n_rows: number of rows to write. default = length of the first column
+
+    Every value is written as "{0:8.6g}  " and every row ends with a newline.
+    """
+    arrays = list(columns) + list(usercolumns)
+    if n_rows is None:
+        n_rows = len(arrays[0]) if arrays else 0
+    if not arrays:
+        return "\n" * n_rows
+
+    table = np.column_stack(
+        [np.asarray(array, dtype=np.float64)[:n_rows] for array in arrays]
+    )
+    row_format = "{:8.6g}  " * table.shape[1] + "\n"
+    return "".join([row_format.format(*row) for row in table.tolist()])
+
+
+def xas_step_layout(h):
+    """
+    Return the layout of the XDI file of an XAS_STEP run.
+
+    Returns (userheader, columns, rois): the user header items, the event
+    data columns and a dict mapping each ROI number to its Xspress3 keys.
+    """
     # Construct basic header information
     userheaderitem = {}
     userheaderitem["uid"] = h.start["uid"]
@@ -144,23 +392,19 @@ def xas_step_exporter(scanid, api_key=None, dry_run=False):
     else:
         raise KeyError("SRS not found in data!")
     # Include fluorescence data if present, allow multiple rois
+    rois = {}
     if "xs" in h.start["detectors"]:
         if "ROI" in h.start["scan"].keys():
             roinum = list(h.start["scan"]["ROI"])
         else:
             roinum = [1]  # if no ROI key found, assume ROI 1
-        logger.info(roinum)
-        for i in roinum:
-            logger.info(f"Current roinumber: {i}")
-            roi_name = "roi{:02}".format(i)
-            roi_key = []
-
-            xs_channels = h["primary"].descriptors[0]["object_keys"]["xs"]
-            for xs_channel in xs_channels:
-                logger.info(f"Current xs_channel: {xs_channel}")
-                if "mca" + roi_name in xs_channel and "total_rbv" in xs_channel:  # noqa: E501
-                    roi_key.append(xs_channel)
-
+        # Map every ROI to its channels in one pass over the xs keys
+        rois = {i: [] for i in roinum}
+        for xs_channel in h["primary"].descriptors[0]["object_keys"]["xs"]:
+            match = XS_ROI_KEY.search(xs_channel)
+            if match and int(match.group(1)) in rois:
+                rois[int(match.group(1))].append(xs_channel)
+        for roi_key in rois.values():
             columnitem.extend(roi_key)
 
     # if ('xs2' in h.start['detectors']):
@@ -173,36 +417,62 @@ def xas_step_exporter(scanid, api_key=None, dry_run=False):
 
     # [columnitem.append(roi) for roi in roi_key]
 
+    return userheaderitem, columnitem, rois
+
+
+@task
+def xas_step_exporter(scanid, api_key=None, dry_run=False, hdf5=False):
+    logger = get_run_logger()
+    with profile("xas_step_exporter"), tiled_requests() as stats:
+        outputs = export_xas_step(scanid, api_key=api_key, dry_run=dry_run, hdf5=hdf5)
+    logger.info(f"Tiled: {stats['requests']} requests, {stats['bytes']:_} bytes")
+    return outputs
+
+
+def export_xas_step(scanid, api_key=None, dry_run=False, hdf5=False):
+    logger = get_run_logger()
+
+    # Custom header list
+    headeritem = []
+    # Load header for our scan
+    with stage("get_run"):
+        h = get_run(scanid, api_key=api_key)
+    set_run(h)
+
+    if h.start["scan"].get("type") != "XAS_STEP":
+        logger.info("Incorrect document type. Not running exporter on this document.")
+        return []
+    userheaderitem, columnitem, rois = xas_step_layout(h)
+    logger.info(f"ROIs: {rois}")
+
+    if not dry_run:
+        # A live export of the run only needs its last rows.
+        with stage("finalize_live"):
+            filepath = finalize_live_export(h)
+        if filepath is not None:
+            logger.info(f"Finalized live export {filepath}")
+            if hdf5:
+                return [filepath, write_live_hdf5_sidecar(h, filepath)]
+            return [filepath]
+
+    # Read plan: the columns (which include the ROI keys and the SRS) and the
+    # ring current of the header are fetched in one bulk read, which is used
+    # for both the ROI sums and the file.
+    dataset_keys = set(h["primary"]["data"])
+    datatablenames = [item for item in columnitem if item in dataset_keys]
+    if "ring_current" in dataset_keys:
+        datatablenames.append("ring_current")
+    with stage("read", stream="primary") as record:
+        datatable = h["primary"].read(datatablenames)
+        record["bytes"] = datatable.nbytes
+    logger.info(f"Read {len(datatablenames)} keys, {datatable.nbytes:_} bytes")
+
     # Construct user convenience columns allowing prescaling of ion chamber,
     # diode and fluorescence detector data
     usercolumnitem = {}
-    datatablenames = []
-
-    if "xs" in h.start["detectors"]:
-        datatablenames.extend(roi_key)
-    if "xs2" in h.start["detectors"]:
-        datatablenames.extend(roi_key)
-    if "sclr1" in h.start["detectors"]:
-        if "sclr_im" in h["primary"].descriptors[0]["object_keys"]["sclr1"]:
-            datatablenames.extend(["sclr_im", "sclr_i0", "sclr_it"])
-            datatable = h["primary"].read(datatablenames)
-        else:
-            datatablenames.extend(["sclr1_mca2", "sclr1_mca3", "sclr1_mca4"])
-            datatable = h["primary"].read(datatablenames)
-    else:
-        raise KeyError
     # Calculate sums for xspress3 channels of interest
-    if "xs" in h.start["detectors"]:
-        for i in roinum:
-            roi_name = "roi{:02}".format(i)
-            roi_key = []
-            for xs_channel in xs_channels:
-                if "mca" + roi_name in xs_channel and "total_rbv" in xs_channel:  # noqa: E501
-                    roi_key.append(xs_channel)
-            roisum = sum(datatable[roi_key].to_array()).to_series()
-            roisum = roisum.rename_axis("seq_num").rename(lambda x: x + 1)
-            usercolumnitem["If-{:02}".format(i)] = roisum
-            # usercolumnitem['If-{:02}'.format(i)].round(0)
+    with stage("reduce"):
+        usercolumnitem.update(xas_step_roi_sums(datatable, rois))
 
     # if 'xs2' in h.start['detectors']:
     #     for i in roinum:
@@ -213,58 +483,319 @@ def xas_step_exporter(scanid, api_key=None, dry_run=False):
 
     if dry_run:
         logger.info("Dry run: Not exporting xanes")
-    else:
-        xanes_textout(
-            scanid=scanid,
-            header=headeritem,
-            userheader=userheaderitem,
-            column=columnitem,
-            usercolumn=usercolumnitem,
-            usercolumnname=usercolumnitem.keys(),
-            output=False,
-            api_key=api_key,
-        )
+        return []
+    filepath = xanes_textout(
+        scanid=scanid,
+        header=headeritem,
+        userheader=userheaderitem,
+        column=columnitem,
+        usercolumn=usercolumnitem,
+        usercolumnname=usercolumnitem.keys(),
+        output=False,
+        api_key=api_key,
+        hdf5=hdf5,
+        data=datatable,
+    )
+    if hdf5:
+        return [filepath, hdf5_sidecar_path(filepath)]
+    return [filepath]
+
+
+def _live_state_path(filepath, suffix="live"):
+    filepath = Path(filepath)
+    return filepath.with_name(f".{filepath.name}.{suffix}")
+
+
+def _load_live_state(h, filepath):
+    # The state is only valid for this run and an untouched file.
+    try:
+        with open(_live_state_path(filepath)) as f:
+            state = json.load(f)
+        if state["uid"] == h.start["uid"] and state["size"] == os.path.getsize(
+            filepath
+        ):
+            return state
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def _write_live_state(filepath, state):
+    state["size"] = os.path.getsize(filepath)
+    with atomic_write(_live_state_path(filepath)) as f:
+        json.dump(state, f)
+
+
+def xas_step_roi_sums(data, rois, n_rows=None):
+    """
+    Return the If-NN column of every ROI, summed over its Xspress3 channels.
+
+    data: mapping of key -> 1-D array of event data (e.g. an xarray Dataset)
+    rois: dict mapping each ROI number to its keys, as from xas_step_layout
+    n_rows: number of points, used for ROIs without keys.
+            default = length of the first key
+
+    The keys are stacked into one (channels x points) array. When every ROI
+    has the same number of channels (the usual case), all sums come from one
+    reduction over it, viewed as (ROIs x channels x points). The channels of
+    each ROI are added in order, as a Python sum() of them would.
+    """
+    keys = [key for roi_key in rois.values() for key in roi_key]
+    if n_rows is None:
+        n_rows = len(data[keys[0]]) if keys else 0
+    sums = {}
+    if keys:
+        table = np.stack([np.asarray(data[key]) for key in keys])
+        numbers = [i for i, roi_key in rois.items() if roi_key]
+        sizes = [len(rois[i]) for i in numbers]
+        if len(set(sizes)) == 1:
+            reduced = table.reshape(len(sizes), sizes[0], -1).sum(axis=1)
+        else:
+            bounds = np.cumsum([0] + sizes)
+            reduced = [table[a:b].sum(axis=0) for a, b in zip(bounds[:-1], bounds[1:])]
+        sums = dict(zip(numbers, reduced))
+    return {
+        "If-{:02}".format(i): sums[i] if i in sums else np.zeros(n_rows) for i in rois
+    }
+
+
+def format_live_rows(dataset_client, columns, rois, start, stop):
+    """
+    Format the rows [start:stop] of an XAS step scan as XDI data lines.
+
+    The ROI sums are computed from the same rows, in the same order as
+    xas_step_exporter does for the whole scan.
+    """
+    data = {item: np.asarray(dataset_client[item][start:stop]) for item in columns}
+    usercolumns = xas_step_roi_sums(data, rois, stop - start).values()
+    return format_xdi_rows([data[item] for item in columns], usercolumns)
+
+
+def _read_live_rows(h, state):
+    """
+    Return the rows of h after those of the live export, as XDI data lines,
+    and the state of the export once they are appended.
+
+    The text is None if there are no new rows.
+    """
+    dataset_client = h["primary"]["data"]
+    columns = state["columns"]
+    seq_num = state["seq_num"]
+    n_rows = min(dataset_client[item].shape[0] for item in columns)
+    if n_rows <= seq_num:
+        return None, state
+    rows = format_live_rows(
+        dataset_client, columns, dict(state["rois"]), seq_num, n_rows
+    )
+    return rows, {**state, "seq_num": n_rows}
+
+
+def _read_live_file(h):
+    """
+    Return the header and rows of a new live export of h, and its state.
+
+    The text is None if the run has no rows yet.
+    """
+    userheader, layout, rois = xas_step_layout(h)
+    dataset_client = h["primary"]["data"]
+    dataset_keys = dataset_client.keys()
+    columns = [item for item in layout if item in dataset_keys]
+    n_rows = min(dataset_client[item].shape[0] for item in columns)
+    if n_rows == 0:
+        return None, None
+    usercolumnname = ["If-{:02}".format(i) for i in rois]
+    # The columns are numbered by their place in the layout, as in
+    # xanes_textout, so the numbers skip the columns that are missing.
+    lines = xanes_header_lines(
+        h, dataset_client, [], userheader, layout, columns, usercolumnname, False
+    )
+    lines.append(format_live_rows(dataset_client, columns, rois, 0, n_rows))
+    state = {
+        "uid": h.start["uid"],
+        "columns": columns,
+        "rois": list(rois.items()),
+        "seq_num": n_rows,
+    }
+    return "".join(lines), state
+
+
+def _live_seq_num(h, filepath):
+    state = _load_live_state(h, filepath)
+    return None if state is None else state["seq_num"]
+
+
+def update_live_export(h):
+    """
+    Write the rows of a running XAS step scan that are not in its file yet.
+
+    The first call writes the header; later calls append the new rows, which
+    are tracked by seq_num in a sidecar state file next to the XDI file.
+    Returns the number of rows written.
+
+    The rows are read from Tiled before the file is locked, and only written
+    if the export did not change in the meantime (otherwise they are read
+    again), so other exports in the process do not wait on the reads.
+    """
+    filepath = xanes_filepath(h.start)
+    create_subdir(Path(filepath).parent)
+    while True:
+        state = _load_live_state(h, filepath)
+        if state is not None:
+            text, new_state = _read_live_rows(h, state)
+        elif os.path.exists(filepath) and h.metadata.get("stop"):
+            # Already exported at the end of the run.
+            return 0
+        else:
+            text, new_state = _read_live_file(h)
+        if text is None:
+            return 0
+        seq_num = None if state is None else state["seq_num"]
+        with file_lock(_live_state_path(filepath, "lock")):
+            if _live_seq_num(h, filepath) != seq_num:
+                continue
+            if state is None:
+                with atomic_write(filepath) as f:
+                    f.write(text)
+            else:
+                with append_write(filepath) as f:
+                    f.write(text)
+            _write_live_state(filepath, new_state)
+        return new_state["seq_num"] - (seq_num or 0)
+
+
+def write_live_hdf5_sidecar(h, filepath):
+    """Write the HDF5 sidecar of a finalized live export from the whole run."""
+    _, columns, rois = xas_step_layout(h)
+    dataset_client = h["primary"]["data"]
+    dataset_keys = dataset_client.keys()
+    data = {
+        item: read_array(dataset_client[item])
+        for item in columns
+        if item in dataset_keys
+    }
+    n_rows = min(len(array) for array in data.values())
+    roi_sums = xas_step_roi_sums(data, rois, n_rows)
+    with open(filepath) as f:
+        header = "".join(line for line in f if line.startswith("#"))
+    return write_hdf5_sidecar(filepath, header, data, roi_sums)
+
+
+def finalize_live_export(h):
+    """
+    Append the last rows to the live export of a finished run.
+
+    Returns the path of the file, or None if there is no valid live export
+    (the whole file is then written by xas_step_exporter).
+    """
+    filepath = xanes_filepath(h.start)
+    state_path = _live_state_path(filepath)
+    if not state_path.exists():
+        return None
+    # As in update_live_export, the rows are read before the file is locked.
+    while True:
+        state = _load_live_state(h, filepath)
+        text = None
+        if state is not None:
+            text, new_state = _read_live_rows(h, state)
+        seq_num = None if state is None else state["seq_num"]
+        # The lock file is removed with the state, so that the runs do not
+        # leave it behind in the proposal.
+        with file_lock(_live_state_path(filepath, "lock"), remove=True):
+            if _live_seq_num(h, filepath) != seq_num:
+                continue
+            if text is not None:
+                with append_write(filepath) as f:
+                    f.write(text)
+                _write_live_state(filepath, new_state)
+            state_path.unlink(missing_ok=True)
+        return filepath if state is not None else None
+
+
+@flow(log_prints=True)
+def xas_step_live_exporter(
+    uid,
+    api_key=None,
+    poll_interval=LIVE_POLL_INTERVAL,
+    idle_timeout=LIVE_IDLE_TIMEOUT,
+):
+    """
+    Export an XAS step scan while it is running.
+
+    The primary stream is polled every poll_interval seconds and new rows are
+    appended to the XDI file. The flow returns when the run has a stop
+    document or no rows arrived for idle_timeout seconds; xas_step_exporter
+    then finalizes the file at the end of the run instead of rewriting it.
+    """
+    logger = get_run_logger()
+    h = get_run.fn(uid, api_key=api_key, refresh=True)
+    if h.start.get("scan", {}).get("type") != "XAS_STEP":
+        logger.info("Incorrect document type. Not running exporter on this document.")
+        return
+
+    scan_id = h.start["scan_id"]
+    last_time = ttime.monotonic()
+    while True:
+        finished = bool(h.metadata.get("stop"))
+        n_rows = update_live_export(h)
+        if n_rows:
+            logger.info(f"Wrote {n_rows} rows of scan {scan_id}")
+            last_time = ttime.monotonic()
+        if finished:
+            logger.info(f"Scan {scan_id} finished")
+            return
+        if ttime.monotonic() - last_time > idle_timeout:
+            logger.info(f"No new rows of scan {scan_id} in {idle_timeout} s")
+            return
+        ttime.sleep(poll_interval)
+        h = get_run.fn(uid, api_key=api_key, refresh=True)
 
 
 @task
-def xas_fly_exporter(uid, api_key=None, dry_run=False):
+def xas_fly_exporter(
+    uid, api_key=None, dry_run=False, max_workers=FLY_EXPORT_WORKERS, hdf5=False
+):
+    with profile("xas_fly_exporter"):
+        return export_xas_fly(uid, api_key, dry_run, max_workers, hdf5)
+
+
+def export_xas_fly(
+    uid, api_key=None, dry_run=False, max_workers=FLY_EXPORT_WORKERS, hdf5=False
+):
+    import pandas as pd
+
     logger = get_run_logger()
     # Get a scan header
-    hdr = get_run(uid, api_key=api_key)
+    with stage("get_run"):
+        hdr = get_run(uid, api_key=api_key)
+    set_run(hdr)
     start_doc = hdr.start
 
     # Get proposal directory location
     cycle = start_doc["cycle"]
-    root = f"/nsls2/data/srx/proposals/{cycle}/{start_doc['data_session']}/xas/"
+    root = f"{PROPOSALS_DIR}/{cycle}/{start_doc['data_session']}/xas/"
 
     create_subdir(root)
 
     # Identify scan streams
     scan_streams = [s for s in hdr if s != "baseline" and "monitor" not in s]
 
-    # ROI information
+    # ROI information. The scan's own ROI (roi_num) keeps the plain channel
+    # column names; the other ROIs are prefixed with their name.
     roi_num = start_doc["scan"]["roi_num"]
-    roi_name = start_doc["scan"]["roi_names"][roi_num - 1]
-    roi_symbol, roi_line = roi_name.split("_")
-    roi_Z = xrl.SymbolToAtomicNumber(roi_symbol)
-    if "ka" in roi_line.lower():
-        roi_line_ind = xrl.KA_LINE
-    elif "kb" in roi_line.lower():
-        roi_line_ind = xrl.KB_LINE
-    elif "la" in roi_line.lower():
-        roi_line_ind = xrl.LA_LINE
-    elif "lb" in roi_line.lower():
-        roi_line_ind = xrl.LB_LINE
-    else:
+    roi_names = start_doc["scan"]["roi_names"]
+    roi_name = roi_names[roi_num - 1]
+    if roi_window(roi_name) is None:
         logger.info("Line identification failed")
-        return
-
-    # Get bin values
-    E = xrl.LineEnergy(roi_Z, roi_line_ind)
-    E_bin = np.round(E * 100, decimals=0).astype(int)
-    E_width = 10
-    E_min = E_bin - E_width
-    E_max = E_bin + E_width
+        return []
+    E_min, E_max = roi_window(roi_name)
+    windows = {"": (E_min, E_max)}
+    for name in roi_names:
+        if name == roi_name or f"{name}_" in windows:
+            continue
+        if roi_window(name) is None:
+            logger.info(f"Line identification failed for ROI {name}; skipping it")
+            continue
+        windows[f"{name}_"] = roi_window(name)
 
     # Get ring current
     ring_current_start = np.round(
@@ -286,74 +817,156 @@ def xas_fly_exporter(uid, api_key=None, dry_run=False):
         + f"# Scan.ROI.name: {roi_name}\n"
         + f"# Scan.ROI.number: {roi_num}\n"
         + f"# Scan.ROI.range: {f'[{E_min}:{E_max}]'}\n"
+        + "".join(
+            f"# Scan.ROI.{prefix[:-1]}.range: [{bin_min}:{bin_max}]\n"
+            for prefix, (bin_min, bin_max) in list(windows.items())[1:]
+        )
         + "# \n"
     )
 
-    for stream in sorted(scan_streams):
+    # The streams, and the keys within each stream, are read concurrently, but
+    # at most max_workers requests are in flight in total.
+    slots = threading.BoundedSemaphore(max_workers)
+
+    def export_stream(stream):
         # Set a filename
         fname = f"scan_{hdr.start['scan_id']}_{stream}.txt"
         fname = root + fname
 
-        # Get the full table
-        tbl = hdr[stream]["data"]
-        df = pd.DataFrame()
-        keys = [k for k in tbl.keys()[:] if "time" not in k]
-        for k in keys:
-            if "channel" in k:
-                # We will process later
-                continue
-            df[k] = np.squeeze(tbl[k].read())
-
-        df.set_index("energy", drop=True, inplace=True)
-
-        ch_names = [ch for ch in keys if "channel" in ch]
-        for ch in ch_names:
-            ch_data = np.squeeze(tbl[ch].read())
-            df[ch] = np.sum(ch_data[:, E_min:E_max], axis=1)
-            df.rename(columns={ch: ch.split("_")[-1]}, inplace=True)
-        df["ch_sum"] = df[[ch for ch in df.keys() if "channel" in ch]].sum(axis=1)
+        with stage("read_reduce", stream=stream):
+            df = read_fly_stream(hdr[stream]["data"], windows, max_workers, slots)
 
         # Prepare for export
         col_names = [df.index.name] + list(df.columns)
+        header = staticheader
         for i, col in enumerate(col_names):
-            staticheader += f"# Column {i + 1:02}: {col}\n"
-        staticheader += "# \n# "
+            header += f"# Column {i + 1:02}: {col}\n"
+        header += "# \n# "
 
         # Export data to file
         if dry_run:
-            logger.info("Dry run: xas fly exporter")
+            logger.info(f"Dry run: xas fly exporter ({stream})")
             if len(df) >= 2:
-                logger.info(
-                    "Dry run: first and last row: {pd.concat([df.head(1), df.tail(1)])}"
-                )
+                rows = pd.concat([df.head(1), df.tail(1)])
+                logger.info(f"Dry run: first and last row: {rows}")
             elif len(df) == 1:
-                logger.info("Dry run: row: {df}")
+                logger.info(f"Dry run: row: {df}")
             else:
                 logger.info("Dry run: (no data)")
-        else:
-            with open(fname, "w") as f:
-                f.write(staticheader)
-            df.to_csv(fname, float_format="%.3f", sep=" ", mode="a")
+            return []
+        with atomic_write(fname) as f:
+            f.write(header)
+            df.to_csv(f, float_format="%.3f", sep=" ")
+        logger.info(f"Exported {stream} to {fname}")
+        if not hdf5:
+            return [fname]
+        channels = [
+            col for col in df.columns if "channel" in col or col.endswith("ch_sum")
+        ]
+        columns = {df.index.name: df.index.to_numpy()}
+        for col in df.columns:
+            if col not in channels:
+                columns[col] = df[col].to_numpy()
+        h5name = write_hdf5_sidecar(
+            fname,
+            header + " ".join(col_names) + "\n",
+            columns,
+            {col: df[col].to_numpy() for col in channels},
+        )
+        return [fname, h5name]
+
+    # Streams are read, reduced and written independently; each file is
+    # written as soon as its stream is done. Each one runs in a copy of the
+    # context so that its stages and writes are recorded.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, export_stream, stream)
+            for stream in sorted(scan_streams)
+        ]
+        fnames = [
+            fname for future in as_completed(futures) for fname in future.result()
+        ]
+    return sorted(fnames)
+
+
+def read_fly_stream(tbl, windows, max_workers=FLY_EXPORT_WORKERS, slots=None):
+    """
+    Read one fly-scan stream into a DataFrame indexed by energy.
+
+    windows: dict mapping a column prefix to an (E_min, E_max) ROI window
+    slots: semaphore bounding the Tiled requests in flight, shared with the
+           other streams read at the same time (default: max_workers slots
+           for this stream)
+
+    Scalar keys are read as they are; each MCA channel is read once and
+    reduced to the sum of every ROI window (roi_window_sums), giving one
+    <prefix>channelNN column per window and channel and a <prefix>ch_sum
+    column per window. Keys are fetched concurrently, each holding one of
+    the slots while it is read.
+    """
+    import pandas as pd
+
+    if slots is None:
+        slots = threading.BoundedSemaphore(max_workers)
+
+    with slots:
+        keys = [k for k in tbl.keys()[:] if "time" not in k]
+
+    def read_key(k):
+        with slots:
+            if "channel" in k:
+                return roi_window_sums(tbl[k], list(windows.values()))
+            return np.squeeze(read_array(tbl[k]))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, read_key, k) for k in keys
+        ]
+        data = dict(zip(keys, (future.result() for future in futures)))
+
+    df = pd.DataFrame({k: data[k] for k in keys if "channel" not in k})
+    df.set_index("energy", drop=True, inplace=True)
+
+    ch_names = [ch for ch in keys if "channel" in ch]
+    for i, prefix in enumerate(windows):
+        columns = [prefix + ch.split("_")[-1] for ch in ch_names]
+        for ch, col in zip(ch_names, columns):
+            df[col] = data[ch][i]
+        df[prefix + "ch_sum"] = df[columns].sum(axis=1)
+    return df
 
 
 @flow(log_prints=True)
-def xanes_exporter(ref, api_key=None, dry_run=False):
+def xanes_exporter(
+    ref, api_key=None, dry_run=False, force=False, hdf5=XAS_HDF5_SIDECAR
+):
     logger = get_run_logger()
     logger.info("Start writing file with xanes_exporter...")
 
+    # Exports without the sidecar are not current once it is requested.
+    version = EXPORTER_VERSION + ("+hdf5" if hdf5 else "")
+    h = get_run(ref, api_key=api_key)
+    if not force and export_is_current(h, "xanes_exporter", version):
+        logger.info(
+            f"Scan {h.start['scan_id']} was already exported. Use force=True to export it again."
+        )
+        return
+
     # Get scan type
-    scan_type = (
-        get_run(ref, api_key=api_key).start.get("scan", {}).get("type", "unknown")
-    )
+    scan_type = h.start.get("scan", {}).get("type", "unknown")
 
     # Redirect to correction function - or pass
+    outputs = []
     if scan_type == "XAS_STEP":
         logger.info("Starting xanes step-scan exporter.")
-        xas_step_exporter(ref, api_key=api_key, dry_run=dry_run)
+        outputs = xas_step_exporter(ref, api_key=api_key, dry_run=dry_run, hdf5=hdf5)
         logger.info("Finished writing file with xanes step-scan exporter.")
     elif scan_type == "XAS_FLY":
         logger.info("Starting xanes fly-scan exporter.")
-        xas_fly_exporter(ref, api_key=api_key, dry_run=dry_run)
+        outputs = xas_fly_exporter(ref, api_key=api_key, dry_run=dry_run, hdf5=hdf5)
         logger.info("Finished writing file with xanes fly-scan exporter.")
     else:
         logger.info(f"xanes exporter for {scan_type=} not available")
+
+    if not dry_run:
+        record_export(h, "xanes_exporter", version, outputs)
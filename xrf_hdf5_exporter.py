@@ -1,22 +1,151 @@
 from prefect import flow, task, get_run_logger
+from prefect.concurrency.sync import concurrency
 
-import glob
+import contextvars
+import math
 import os
-import stat
-import pyxrf
-import dask
-from pyxrf.api import make_hdf
+import time as ttime
+from contextlib import ExitStack
+import numpy as np
 
-from data_validation import get_run, get_api_key_from_env
+from instrumentation import add_stage, profile, set_run, stage
+from data_validation import TILED_URI, PROPOSALS_DIR, get_run, get_api_key_from_env
+from export_manifest import export_is_current, record_export
 from xanes_exporter import create_subdir
 
 # from pyxrf.api import make_hdf
 
 CATALOG_NAME = "srx"
 
+# Bump when the exported files change, so that runs recorded in the export
+# manifest are exported again.
+EXPORTER_VERSION = "1"
+
+# Prefect global concurrency limit that budgets the memory used by make_hdf
+# across flow runs, in GiB. Each job occupies as many slots as the GiB it is
+# estimated to need, so large maps queue while small ones pass through. The
+# budget is the size of the limit, sized to the memory of the worker:
+#   prefect gcl create xrf-hdf5-memory-gib --limit 48
+XRF_MEMORY_LIMIT = "xrf-hdf5-memory-gib"
+
+# Seconds to wait for the memory budget; after that make_hdf runs anyway (and
+# a warning is logged) rather than leaving the flow run waiting forever.
+XRF_MEMORY_WAIT_TIMEOUT = 2 * 3600
+
+# Mode of the files written by make_hdf: read/write for user and group only.
+XRF_FILE_MODE = 0o660
+
+# Tiled API key of the make_hdf call of the current context, see _pyxrf_catalog.
+_pyxrf_api_key = contextvars.ContextVar("pyxrf_api_key", default=None)
+
+# Used to estimate the footprint when the event descriptors do not say.
+XRF_DEFAULT_CHANNELS = 8
+XRF_DEFAULT_BINS = 4096
+XRF_DEFAULT_ITEMSIZE = 4
+
+# make_hdf holds the raw spectra and their channel sum at the same time.
+XRF_MEMORY_OVERHEAD = 2
+
+
+def is_xrf_map(start, streams):
+    """Return True if xrf_hdf5_exporter applies to a run (no alignment scans)."""
+    scan = start.get("scan", {})
+    if scan.get("type") not in ["XRF_FLY", "XRF_STEP"]:
+        return False
+    # A fly scan with a single line is likely an alignment scan.
+    idx_NUM_PTS_Y = 5
+    try:
+        return not (
+            scan["type"] == "XRF_FLY" and scan["scan_input"][idx_NUM_PTS_Y] == 1
+        )
+    except (KeyError, IndexError):
+        return True
+
+
+def estimate_xrf_bytes(h):
+    """
+    Estimate the memory make_hdf needs for a map, in bytes.
+
+    nx x ny is taken from scan_input; the number of MCA channels, bins and the
+    dtype from the event descriptors, with defaults for what is missing.
+    Returns None if the map size is unknown.
+    """
+    # scan_input is [startx, stopx, num pts x, starty, stopy, num pts y, dwell]
+    try:
+        scan_input = h.start["scan"]["scan_input"]
+        nx, ny = int(scan_input[2]), int(scan_input[5])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+    n_channels = XRF_DEFAULT_CHANNELS
+    n_bins = XRF_DEFAULT_BINS
+    itemsize = XRF_DEFAULT_ITEMSIZE
+    try:
+        data_keys = h["stream0"].descriptors[0]["data_keys"]
+    except (KeyError, IndexError):
+        data_keys = {}
+    channels = [
+        data_key
+        for key, data_key in data_keys.items()
+        if "channel" in key and len(data_key.get("shape", [])) > 1
+    ]
+    if channels:
+        n_channels = len(channels)
+        n_bins = channels[0]["shape"][-1]
+        if "dtype_numpy" in channels[0]:
+            itemsize = np.dtype(channels[0]["dtype_numpy"]).itemsize
+
+    return nx * ny * n_channels * n_bins * itemsize * XRF_MEMORY_OVERHEAD
+
+
+def _pyxrf_catalog(catalog_name):
+    """
+    Return the catalog make_hdf reads from, opened with the API key of the
+    calling task.
+
+    Replaces pyxrf's get_catalog, which opens it with the TILED_API_KEY
+    environment variable, i.e. one key per process.
+    """
+    from tiled.client import from_uri
+
+    client = from_uri(TILED_URI, "dask", api_key=_pyxrf_api_key.get())
+    return client[catalog_name.lower()]["raw"]
+
+
+def xrf_memory_budget():
+    """
+    Return the size of the XRF_MEMORY_LIMIT concurrency limit in GiB.
+
+    Returns None if the limit does not exist (jobs are then not throttled).
+    """
+    from prefect.client.orchestration import get_client
+    from prefect.exceptions import ObjectNotFound
+
+    with get_client(sync_client=True) as client:
+        try:
+            limit = client.read_global_concurrency_limit_by_name(XRF_MEMORY_LIMIT)
+        except ObjectNotFound:
+            return None
+    return limit.limit
+
 
 @task
 def export_xrf_hdf5(scanid, api_key=None, dry_run=False):
+    with profile("export_xrf_hdf5"):
+        return write_xrf_hdf5(scanid, api_key=api_key, dry_run=dry_run)
+
+
+def write_xrf_hdf5(scanid, api_key=None, dry_run=False):
+    # pyxrf and dask take seconds to import, so they are only imported by
+    # the task that uses them rather than by every flow importing this module.
+    import dask
+    import pyxrf
+    import pyxrf.model.load_data_from_db
+    from pyxrf.api import make_hdf
+
+    # make_hdf looks up the catalog by name through this module's get_catalog.
+    pyxrf.model.load_data_from_db.get_catalog = _pyxrf_catalog
+
     logger = get_run_logger()
 
     logger.info(f"{pyxrf.__file__ = }")
@@ -24,13 +153,15 @@ def export_xrf_hdf5(scanid, api_key=None, dry_run=False):
     logger.info(f"{dask.__file__ = }")
 
     # Load header for our scan
-    h = get_run(scanid, api_key=api_key)
+    with stage("get_run"):
+        h = get_run(scanid, api_key=api_key)
+    set_run(h)
 
     if h.start["scan"]["type"] not in ["XRF_FLY", "XRF_STEP"]:
         logger.info(
             "Incorrect document type. Not running pyxrf.api.make_hdf on this document."
         )
-        return
+        return []
 
     # Check if this is an alignment scan
     # scan_input array consists of [startx, stopx, number pts x, start y, stop y, num pts y, dwell]
@@ -42,37 +173,93 @@ def export_xrf_hdf5(scanid, api_key=None, dry_run=False):
         logger.info(
             "This is likely an alignment scan. Not running pyxrf.api.make_hdf on this document."
         )
-        return
+        return []
 
-    working_dir = f"/nsls2/data/srx/proposals/{h.start['cycle']}/{h.start['data_session']}/xrfmaps"  # noqa: E501
+    working_dir = (
+        f"{PROPOSALS_DIR}/{h.start['cycle']}/{h.start['data_session']}/xrfmaps"  # noqa: E501
+    )
 
     create_subdir(working_dir)
 
-    os.umask(0o007)  # Read/write access for user and group only
-
     prefix = "autorun_scan2D_"
 
     logger.info(f"{working_dir =}")
     if not api_key:
-        get_api_key_from_env()  # in container, get Tiled API key from file
-    else:
-        os.environ["TILED_API_KEY"] = (
-            api_key  # pyxrf assumes Tiled API key as an environment variable
-        )
+        api_key = get_api_key_from_env()  # in container, get Tiled API key from file
     if dry_run:
         logger.info("Dry run: not creating HDF5 file using PyXRF")
-    else:
-        make_hdf(scanid, wd=working_dir, prefix=prefix, catalog_name=CATALOG_NAME)
+        return []
+
+    # Wait for enough of the memory budget before running make_hdf. Jobs of
+    # unknown size, and jobs larger than the budget, take the whole budget.
+    budget = xrf_memory_budget()
+    nbytes = estimate_xrf_bytes(h)
+    with ExitStack() as stack:
+        if budget is None:
+            logger.info(f"No {XRF_MEMORY_LIMIT} concurrency limit; not waiting")
+        elif budget < 1:
+            logger.warning(f"{XRF_MEMORY_LIMIT} has no slots; not waiting")
+        else:
+            if nbytes is None:
+                gib = budget
+                logger.info(f"Map size unknown; reserving {gib} GiB")
+            else:
+                gib = min(max(math.ceil(nbytes / 2**30), 1), budget)
+                logger.info(
+                    f"Estimated make_hdf footprint: {nbytes:_} bytes ({gib} GiB)"
+                )
+            start_time = ttime.monotonic()
+            try:
+                stack.enter_context(
+                    concurrency(
+                        XRF_MEMORY_LIMIT,
+                        occupy=gib,
+                        timeout_seconds=XRF_MEMORY_WAIT_TIMEOUT,
+                        strict=False,
+                    )
+                )
+            except TimeoutError:
+                logger.warning(
+                    f"No {gib} GiB of {XRF_MEMORY_LIMIT} free after "
+                    f"{XRF_MEMORY_WAIT_TIMEOUT} s; running make_hdf anyway"
+                )
+            wait_time = ttime.monotonic() - start_time
+            logger.info(f"Waited {wait_time:.1f} s for {gib} GiB of {XRF_MEMORY_LIMIT}")
+            add_stage("wait_memory", wait_time)
+        with stage("make_hdf") as record:
+            token = _pyxrf_api_key.set(api_key)
+            try:
+                make_hdf(
+                    scanid, wd=working_dir, prefix=prefix, catalog_name=CATALOG_NAME
+                )
+            finally:
+                _pyxrf_api_key.reset(token)
 
-        # chmod g+w for created file(s)
-        # context: https://nsls2.slack.com/archives/C04UUSG88VB/p1718911163624149
-        for file in glob.glob(f"{working_dir}/{prefix}{scanid}*.h5"):
-            os.chmod(file, os.stat(file).st_mode | stat.S_IWGRP)
+    # make_hdf writes the files itself, so their mode is set afterwards:
+    # read/write for user and group only. (A umask would apply to the files
+    # that the exporters running in the other threads write at the same time.)
+    # Without fname_add_version, make_hdf names its file exactly
+    # <prefix><scan id>.h5; a wider pattern would also match other scans,
+    # e.g. scan 1234 for scan 123.
+    path = os.path.join(working_dir, f"{prefix}{h.start['scan_id']}.h5")
+    files = [path] if os.path.exists(path) else []
+    for file in files:
+        os.chmod(file, XRF_FILE_MODE)
+    record["bytes"] = sum(os.path.getsize(file) for file in files)
+    return files
 
 
 @flow(log_prints=True)
-def xrf_hdf5_exporter(scanid, api_key=None, dry_run=False):
+def xrf_hdf5_exporter(scanid, api_key=None, dry_run=False, force=False):
     logger = get_run_logger()
     logger.info("Start writing file with xrf_hdf5 exporter...")
-    export_xrf_hdf5(scanid, api_key=api_key, dry_run=dry_run)
+    h = get_run(scanid, api_key=api_key)
+    if not force and export_is_current(h, "xrf_hdf5_exporter", EXPORTER_VERSION):
+        logger.info(
+            f"Scan {h.start['scan_id']} was already exported. Use force=True to export it again."
+        )
+        return
+    outputs = export_xrf_hdf5(scanid, api_key=api_key, dry_run=dry_run)
+    if not dry_run:
+        record_export(h, "xrf_hdf5_exporter", EXPORTER_VERSION, outputs)
     logger.info("Finish writing file with xrf_hdf5 exporter.")